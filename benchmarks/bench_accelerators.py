@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the accelerators of the multipass retrieval. Retrieves both
+components of a dataset with each accelerator from the same initial phase and
+reports the iterations and the time needed to reach the target MSE, together
+with the final MSE of each component.
+
+    python benchmarks/bench_accelerators.py sims --pixel-size 0.0469 --lamb 0.52
+"""
+import argparse
+import time
+import numpy as np
+
+from phase_retriever.retriever import PhaseRetriever
+from phase_retriever.algorithm import multi_batched, ACCELERATORS
+
+def iterations_to_eps(mses, eps):
+    """Number of iterations until every component reached eps, or None."""
+    done = []
+    for mse in mses.T:
+        below = np.flatnonzero((mse > 0) & (mse < eps))
+        if not len(below):
+            return None
+        done.append(below[0]+1)
+    return max(done)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("path", help="Folder of the dataset")
+    parser.add_argument("--pixel-size", type=float, required=True)
+    parser.add_argument("--lamb", type=float, required=True)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--niter", type=int, default=200)
+    parser.add_argument("--eps", type=float, default=0.01)
+    parser.add_argument("--tol", type=float, default=1e-4, help="Tolerance of the bandwidth estimation")
+    parser.add_argument("--depth", type=int, default=5, help="History of the anderson accelerator")
+    parser.add_argument("--workers", type=int, default=-1)
+    args = parser.parse_args()
+
+    retriever = PhaseRetriever(n_max=args.niter)
+    retriever.load_dataset(args.path)
+    retriever.config(pixel_size=args.pixel_size, lamb=args.lamb, dim=args.dim, eps=args.eps)
+    retriever.center_window()
+    retriever.select_phase_origin()
+    retriever.compute_bandwidth(tol=args.tol)
+    H, As = retriever.prepare_inputs()
+    phi0 = np.random.default_rng(0).random((args.dim, args.dim))
+    options = {"anderson": {"depth": args.depth}}
+
+    print(f"dim = {args.dim}, planes = {len(As)}, eps = {args.eps}")
+    for name in ACCELERATORS:
+        t0 = time.perf_counter()
+        _, mses, _ = multi_batched(H, args.niter, phi0, As, eps=args.eps, workers=args.workers,
+                accelerator=name, accelerator_options=options.get(name))
+        t = time.perf_counter()-t0
+        n = iterations_to_eps(mses, args.eps)
+        final = [mse[mse > 0][-1] for mse in mses.T]
+        reached = f"{n:5d} it.\t{t:7.2f} s" if n else f"  not reached ({t:.2f} s)"
+        print(f"{name:10s}\t{reached}\tfinal MSE " + "  ".join(f"{e:8.3g}" for e in final))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the iteration kernel of the multipass retrieval. Reports the time
+per iteration and the memory traced by tracemalloc, in units of one complex
+field of the batch. The peak of the kernel must not grow with the number of
+iterations, as all its work buffers are allocated before the loop. For
+comparison, the temporaries created by one naive iteration written with plain
+numpy expressions are also given.
+
+    python benchmarks/bench_multi.py --dim 1024 --planes 10
+"""
+import argparse
+import time
+import tracemalloc
+import numpy as np
+from scipy.fft import fft2, ifft2
+
+from phase_retriever.algorithm import multi_batched
+
+def synthetic_problem(dim, planes, batch, bw=0.1):
+    """Random band limited moduli and a transfer function with bandwidth bw
+    (fraction of the sampling frequency)."""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[-dim//2:dim//2, -dim//2:dim//2]/dim
+    mask = np.fft.fftshift(x*x+y*y < bw*bw)
+    H = np.exp(2j*np.pi*np.sqrt(np.clip(1-(x*x+y*y)*4, 0, None)))
+    H = np.fft.fftshift(H)*mask
+    U = ifft2(fft2(rng.standard_normal((batch, dim, dim)))*mask)
+    As = []
+    for _ in range(planes):
+        As.append(abs(U))
+        U = ifft2(fft2(U)*H)
+    phi0 = rng.random((dim, dim))
+    return H, phi0, np.stack(As)
+
+def naive_iteration(H, H_back, yk, As):
+    """One iteration of the projections, the way they were written before the
+    kernel used preallocated buffers."""
+    for Ai in As[:-1]:
+        Ui = ifft2(fft2(Ai*yk)*H)
+        yk[:] = Ui/(abs(Ui)+1e-16)
+    Ui = ifft2(fft2(As[-1]*yk)*H_back)
+    yk[:] = Ui/(abs(Ui)+1e-16)
+    return np.sum((abs(Ui)-As[0])**2, axis=(-2, -1))
+
+def traced(fun, *args, **kwargs):
+    """Run fun and return its running time and the peak memory traced."""
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    t0 = time.perf_counter()
+    fun(*args, **kwargs)
+    t = time.perf_counter()-t0
+    peak = tracemalloc.get_traced_memory()[1]-base
+    tracemalloc.stop()
+    return t, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--planes", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--niter", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=-1)
+    args = parser.parse_args()
+
+    H, phi0, As = synthetic_problem(args.dim, args.planes, args.batch)
+    field = args.batch*args.dim**2*16  # Bytes of a complex field of the whole batch
+    print(f"dim = {args.dim}, planes = {args.planes}, batch = {args.batch}")
+
+    # Kernel: the memory used by one iteration and by niter must be the same
+    kw = {"eps": 0, "workers": args.workers}
+    t1, peak1 = traced(multi_batched, H, 1, phi0, As, **kw)
+    tn, peakn = traced(multi_batched, H, args.niter+1, phi0, As, **kw)
+    per_iter = (tn-t1)/args.niter
+    growth = max(peakn-peak1, 0)/field/args.niter
+    print(f"kernel:\t{per_iter*1e3:8.2f} ms/iteration\t"
+          f"peak {peak1/field:5.2f} fields (1 it.), {peakn/field:5.2f} fields ({args.niter+1} it.)\t"
+          f"growth {growth:5.2f} fields/iteration")
+
+    # Naive iteration: every operation allocates a temporary
+    yk = np.exp(1j*phi0)*np.ones((args.batch, 1, 1))
+    H_back = np.conj(H)**(args.planes-1)
+    t, peak = traced(naive_iteration, H, H_back, yk, As)
+    print(f"naive:\t{t*1e3:8.2f} ms/iteration\t"
+          f"peak {peak/field:5.2f} fields of temporaries/iteration")
+
+if __name__ == "__main__":
+    main()
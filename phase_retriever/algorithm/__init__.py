@@ -1 +1,5 @@
-from .multipass_retrieval import multi
+from .multipass_retrieval import multi, multi_batched, PRECISIONS
+from .ensemble import multi_ensemble
+from .accelerators import ACCELERATORS
+from .transport import SharedTransport
+from .pool import RetrievalPool
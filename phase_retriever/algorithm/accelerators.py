@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ACCELERATORS OF THE FIXED POINT ITERATION
+    The multipass retrieval is a fixed point iteration y_{k+1} = psi(y_k). The
+accelerators compute the next estimation y_{k+1} from x_k = psi(y_k), the
+residual g_k = psi(y_k)-y_k, the previous residual and h_k = x_k-x_{k-1}. All
+of them work in place on the buffers of multi_batched, on the first m rows of
+the batch (the ones still iterating).
+"""
+import numpy as np
+
+class Accelerator:
+    """Base class. Subclasses implement step and, if they keep state of their
+    own, the methods to compact, promote, save and restore it."""
+    def __init__(self, shape, dtype):
+        self.shape = shape
+        self.dtype = dtype
+
+    def step(self, x, y, g1, g2, h, scratch, coefs):
+        """Write the next estimation into y. coefs receives the acceleration
+        parameter of each row, for monitoring purposes."""
+        raise NotImplementedError
+
+    def compact(self, keep):
+        """Keep only the rows marked by keep, moving them to the front."""
+        pass
+
+    def promote(self, dtype):
+        """Change the dtype of the stored state."""
+        self.dtype = dtype
+
+    def state(self):
+        """Dict of arrays with the state of the accelerator."""
+        return {}
+
+    def restore(self, state):
+        pass
+
+class AlphaAccelerator(Accelerator):
+    """Default scheme: y_{k+1} = x_k+alpha*h_k, with alpha the projection of the
+    current residual on the previous one, clamped to [0, 1]."""
+    def step(self, x, y, g1, g2, h, scratch, coefs):
+        for b in range(len(x)):
+            coefs[b] = np.real(np.vdot(g1[b], g2[b])/(np.vdot(g2[b], g2[b])+1e-16))
+        np.clip(coefs, 0, 1, out=coefs)   # 0 < alpha < 1
+        np.multiply(h, coefs[:, np.newaxis, np.newaxis].astype(h.real.dtype), out=h)
+        np.add(x, h, out=y)
+
+class NesterovAccelerator(Accelerator):
+    """Nesterov momentum, y_{k+1} = x_k+beta_k*h_k with beta_k = (t_k-1)/t_{k+1},
+    with adaptive restart: the momentum of a row is reset whenever its residual
+    grows."""
+    def __init__(self, shape, dtype):
+        super().__init__(shape, dtype)
+        self.t = np.ones(shape[0])
+        self.norm = np.full(shape[0], np.inf)   # Norm of the previous residual
+
+    def step(self, x, y, g1, g2, h, scratch, coefs):
+        m = len(x)
+        t = self.t[:m]
+        for b in range(m):
+            norm = np.real(np.vdot(g1[b], g1[b]))
+            if norm > self.norm[b]:
+                t[b] = 1    # Restart
+            self.norm[b] = norm
+        t_next = (1+np.sqrt(1+4*t*t))/2
+        coefs[:] = (t-1)/t_next
+        t[:] = t_next
+        np.multiply(h, coefs[:, np.newaxis, np.newaxis].astype(h.real.dtype), out=h)
+        np.add(x, h, out=y)
+
+    def compact(self, keep):
+        m = np.count_nonzero(keep)
+        self.t[:m] = self.t[:len(keep)][keep]
+        self.norm[:m] = self.norm[:len(keep)][keep]
+
+    def state(self):
+        return {"t": self.t.copy(), "norm": self.norm.copy()}
+
+    def restore(self, state):
+        self.t[:] = state["t"]
+        self.norm[:] = state["norm"]
+
+class AndersonAccelerator(Accelerator):
+    """Anderson mixing (type II) with a history of depth iterations. The next
+    estimation is y_{k+1} = x_k-dG*gamma, where gamma minimizes |g_k-dF*gamma|,
+    dF and dG being the last differences of residuals and of x. The Gram
+    matrices of dF are updated incrementally, one column per iteration, and
+    regularized with reg. The history of a row is cleared when its residual
+    grows."""
+    def __init__(self, shape, dtype, depth=5, reg=1e-10):
+        super().__init__(shape, dtype)
+        self.depth = depth
+        self.reg = reg
+        batch = shape[0]
+        self.dF = np.zeros((depth,)+shape, dtype=dtype)
+        self.dG = np.zeros((depth,)+shape, dtype=dtype)
+        self.gram = np.zeros((batch, depth, depth))
+        self.n = np.zeros(batch, dtype=np.int_)  # Columns of history of each row
+        self.pos = 0    # Column where the next differences are stored
+        self.norm = np.full(batch, np.inf)
+        self.started = False   # There are no differences at the first iteration
+
+    def step(self, x, y, g1, g2, h, scratch, coefs):
+        m = len(x)
+        np.copyto(y, x)
+        if not self.started:
+            self.started = True
+            coefs[:] = 0
+            return
+        j = self.pos
+        dF, dG = self.dF[j, :m], self.dG[j, :m]
+        np.subtract(g1, g2, out=dF)
+        np.copyto(dG, h)
+        self.pos = (j+1) % self.depth
+        for b in range(m):
+            norm = np.real(np.vdot(g1[b], g1[b]))
+            restart = norm > self.norm[b]
+            self.norm[b] = norm
+            if restart:
+                # Forget the history and take a plain step from the new differences
+                self.n[b] = 0
+                self.gram[b] = 0
+                coefs[b] = 0
+                continue
+            self.n[b] = min(self.n[b]+1, self.depth)
+            # Update the row and column of the Gram matrix for the new differences
+            cols = self._columns(j, self.n[b])
+            for c in cols:
+                self.gram[b, j, c] = self.gram[b, c, j] = np.real(np.vdot(self.dF[c, b], dF[b]))
+            G = self.gram[b][np.ix_(cols, cols)]
+            rhs = np.array([np.real(np.vdot(self.dF[c, b], g1[b])) for c in cols])
+            G += self.reg*(np.trace(G)+1e-16)*np.eye(len(cols))
+            gamma = np.linalg.solve(G, rhs)
+            coefs[b] = gamma.sum()
+            for c, gc in zip(cols, gamma):
+                np.multiply(self.dG[c, b], gc, out=scratch[b])
+                np.subtract(y[b], scratch[b], out=y[b])
+
+    def _columns(self, j, n):
+        """Columns holding the last n differences, the newest being j."""
+        return [(j-i) % self.depth for i in range(n)]
+
+    def compact(self, keep):
+        m = np.count_nonzero(keep)
+        for buf in (self.dF, self.dG):
+            buf[:, :m] = buf[:, :len(keep)][:, keep]
+        for buf in (self.gram, self.n, self.norm):
+            buf[:m] = buf[:len(keep)][keep]
+
+    def promote(self, dtype):
+        super().promote(dtype)
+        self.dF = self.dF.astype(dtype)
+        self.dG = self.dG.astype(dtype)
+
+    def state(self):
+        return {"dF": self.dF.copy(), "dG": self.dG.copy(), "gram": self.gram.copy(),
+                "n": self.n.copy(), "pos": self.pos, "norm": self.norm.copy(),
+                "started": self.started}
+
+    def restore(self, state):
+        self.dF[:] = state["dF"]
+        self.dG[:] = state["dG"]
+        self.gram[:] = state["gram"]
+        self.n[:] = state["n"]
+        self.norm[:] = state["norm"]
+        self.pos = int(state["pos"])
+        self.started = bool(state["started"])
+
+ACCELERATORS = {
+        "alpha"     : AlphaAccelerator,
+        "nesterov"  : NesterovAccelerator,
+        "anderson"  : AndersonAccelerator,
+        }
+
+def make_accelerator(name, shape, dtype, **options):
+    """Create the accelerator called name for a batch of the given shape."""
+    if name not in ACCELERATORS:
+        raise ValueError(f"Unknown accelerator {name}, must be one of {list(ACCELERATORS)}")
+    return ACCELERATORS[name](shape, dtype, **options)
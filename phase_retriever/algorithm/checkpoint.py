@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CHECKPOINTS OF THE ITERATION STATE
+    Periodic snapshots of the state of multi_batched, written to disk by a
+background thread so that the iterations never wait for the disk. A snapshot
+can be fed back to multi_batched (state=...) to continue bit-identically from
+the iteration where it was taken.
+"""
+import os
+import queue
+import threading
+import numpy as np
+
+class CheckpointWriter:
+    """Writes the snapshots submitted to it on a background thread. Only the
+    latest snapshot is kept pending: if the disk is slower than the iterations,
+    older snapshots are discarded instead of blocking the caller."""
+    def __init__(self, path):
+        self.path = path
+        self.pending = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, snapshot):
+        """Queue a snapshot (a dict of arrays, owned by the writer from now on)."""
+        while True:
+            try:
+                self.pending.put_nowait(snapshot)
+                return
+            except queue.Full:
+                # Drop the older snapshot the writer has not taken yet
+                try:
+                    self.pending.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        """Wait for the pending snapshot to be written and stop the thread."""
+        self.pending.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            snapshot = self.pending.get()
+            if snapshot is None:
+                break
+            save_checkpoint(self.path, snapshot)
+
+def save_checkpoint(path, snapshot):
+    """Atomically write snapshot into path, so that a crash while writing never
+    leaves a corrupt checkpoint behind."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **snapshot)
+    os.replace(tmp, path)
+
+def load_checkpoint(path):
+    """Load a checkpoint written by multi_batched as a dict of arrays."""
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
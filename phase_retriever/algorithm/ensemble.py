@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from .multipass_retrieval import multi_batched
+from .transport import DONE
+
+def multi_ensemble(H, niter, As, n_seeds, seed=None, verbose=False, transport=None,
+        stats=None, eps=0.01, workers=-1, precision="double", n_polish=10,
+        warmup=20, every=5, window=10, margin=0.01, checkpoint=None, checkpoint_every=50,
+        state=None, phi0=None, accelerator="alpha", accelerator_options=None):
+    """Multi-start multipass phase retrieval. Runs n_seeds random initial phases
+    for each set of moduli as a single batch through multi_batched. Seeds whose
+    MSE trajectory shows they cannot catch up with the best seed of their set
+    are pruned during the iterations, so that the remaining ones run faster.
+
+    Parameters:
+        - H: Free space transfer function between two planes, shape (ny, nx).
+        - niter: Maximum number of iterations for the algorithm
+        - As: Moduli of the complex amplitudes, shape (planes, n_sources, ny, nx).
+        - n_seeds: Number of initial phases tried for each source.
+        - seed: Seed of the random generator of the initial phases.
+        - verbose: Print status of the phase retrieval at each iteration.
+        - transport: Optional SharedTransport with a source for each set of moduli,
+        where the MSE of its best seed is pushed at each iteration and the best
+        estimation is written at the end.
+        - stats: Optional queue where the per seed statistics are put at the end,
+        before the status of the transport is set to DONE.
+        - eps, workers, precision, n_polish, checkpoint, checkpoint_every, state,
+        accelerator, accelerator_options:
+        See multi_batched. When resuming from a state, the pruning history is
+        recovered from the MSEs stored in it.
+        - phi0: Optional initial phase of each source, shape (n_sources, ny, nx),
+        used by its first seed instead of a random one.
+        - warmup: Iterations before any seed can be pruned.
+        - every: Iterations between two pruning checks.
+        - window: Number of iterations used to estimate the convergence rate
+        of each seed.
+        - margin: Relative MSE excess over the best seed of the set before a
+        seed can be pruned.
+    Output:
+        - xk: Best estimation of exp(i*phi) for each source, shape (n_sources, ny, nx).
+        - MSE: MSE of the best seed of each source at each iteration, shape
+        (niter, n_sources).
+        - statistics: Dictionary with the per seed statistics, arrays of shape
+        (n_sources, n_seeds): "mse" (last MSE), "iterations" (iterations run) and
+        "pruned" (whether the seed was pruned). "best" holds the index of the
+        best seed of each source.
+    """
+    n_planes, n_sources, ny, nx = np.shape(As)
+    rng = np.random.default_rng(seed)
+    # The seeds of each source are contiguous in the batch
+    sources = np.repeat(np.arange(n_sources), n_seeds)
+    phi0_seeds = None
+    if state is None:
+        phi0_seeds = rng.random((len(sources), ny, nx))
+        if phi0 is not None:
+            phi0_seeds[::n_seeds] = phi0
+    pruner = _TrajectoryPruner(niter, sources, warmup, every, window, margin, transport)
+    if state is not None:
+        pruner.restore(state, eps)
+    xk, mses, _ = multi_batched(H, niter, phi0_seeds, As, verbose=verbose, eps=eps, workers=workers,
+            precision=precision, n_polish=n_polish, sources=sources, prune=pruner,
+            checkpoint=checkpoint, checkpoint_every=checkpoint_every, state=state,
+            accelerator=accelerator, accelerator_options=accelerator_options)
+    del phi0_seeds
+
+    # Statistics of each seed
+    iterations = np.count_nonzero(mses, axis=0)
+    last = mses[np.maximum(iterations-1, 0), np.arange(len(sources))]
+    statistics = {
+            "mse"       : last.reshape((n_sources, n_seeds)),
+            "iterations": iterations.reshape((n_sources, n_seeds)),
+            "pruned"    : pruner.pruned.reshape((n_sources, n_seeds)),
+            }
+    best = np.argmin(statistics["mse"], axis=-1)
+    statistics["best"] = best
+    rows = np.arange(n_sources)*n_seeds+best
+    xk = xk[rows]
+    mses = mses[:, rows]
+    if stats:
+        stats.put(statistics)
+    if transport:
+        transport.result[:] = xk
+        transport.status = DONE
+    return xk, mses, statistics
+
+class _TrajectoryPruner:
+    """Pruning rule of multi_ensemble. A seed is pruned when its MSE exceeds the
+    best one of its source by more than margin and, extrapolating its convergence
+    rate over the last window iterations, it would not reach the best MSE
+    before the end of the iterations. The best seed of each source is never
+    pruned. It also reports the best MSE of each source through the transport."""
+    def __init__(self, niter, sources, warmup, every, window, margin, transport=None):
+        self.niter = niter
+        self.sources = sources
+        self.warmup = max(warmup, window)
+        self.every = every
+        self.window = window
+        self.margin = margin
+        self.transport = transport
+        self.history = np.zeros((niter, len(sources)))
+        self.pruned = np.zeros(len(sources), dtype=bool)
+
+    def restore(self, state, eps):
+        """Recover the history from a checkpoint of multi_batched. The seeds that
+        were no longer iterating and had not reached eps were pruned."""
+        n = min(self.niter, len(state["mses"]))
+        self.history[:n] = state["mses"][:n]
+        done = np.ones(len(self.sources), dtype=bool)
+        done[state["active"]] = False
+        iterations = np.count_nonzero(self.history, axis=0)
+        last = self.history[np.maximum(iterations-1, 0), np.arange(len(self.sources))]
+        self.pruned = done & (last >= eps)
+
+    def __call__(self, i, active, mse):
+        self.history[i, active] = mse
+        groups = self.sources[active]
+        if self.transport:
+            for s in np.unique(groups):
+                self.transport.push(s, mse[groups == s].min())
+        drop = np.zeros(len(active), dtype=bool)
+        if i < self.warmup or (i-self.warmup) % self.every:
+            return drop
+        remaining = self.niter-1-i
+        rate = (self.history[i-self.window, active]-mse)/self.window
+        projected = mse-np.maximum(rate, 0)*remaining
+        for s in np.unique(groups):
+            group = groups == s
+            best = mse[group].min()
+            drop |= group & (mse > best*(1+self.margin)) & (projected > best)
+        self.pruned[active[drop]] = True
+        return drop
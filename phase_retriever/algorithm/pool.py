@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PERSISTENT POOL OF RETRIEVAL PROCESSES
+    Starting a process for each retrieval means pickling the transfer functions
+and every amplitude plane, importing NumPy and SciPy again and planning every
+FFT from scratch. The workers of a RetrievalPool live between retrievals: they
+keep the last inputs they received (and the FFT plans cached by scipy.fft), so
+that a job whose inputs carry the same key only sends the initial phase and the
+options. Progress and results go through a SharedTransport, as usual.
+"""
+import multiprocessing as mp
+from multiprocessing import resource_tracker
+import traceback
+
+from .multipass_retrieval import multi_batched
+from .ensemble import multi_ensemble
+from .transport import FAILED
+
+def _batched(H, As, **kwargs):
+    # The result is sent through the transport, only the history is returned
+    _, mses, alphes = multi_batched(H, As=As, **kwargs)
+    return {"mses": mses, "alphes": alphes}
+
+def _ensemble(H, As, **kwargs):
+    return multi_ensemble(H, As=As, **kwargs)[2]
+
+TARGETS = {
+        "batched"   : _batched,
+        "ensemble"  : _ensemble,
+        }
+
+def _serve(conn):
+    """Main loop of a worker. Each message is (key, H, As, target, kwargs); H
+    and As are None when the worker already holds the inputs of key."""
+    inputs = (None, None, None)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        key, H, As, target, kwargs = message
+        if H is not None:
+            inputs = (key, H, As)
+        transport = kwargs.get("transport")
+        try:
+            if inputs[0] != key:
+                raise RuntimeError("Inputs of the job not resident in the worker")
+            reply = ("done", TARGETS[target](inputs[1], inputs[2], **kwargs))
+        except Exception:
+            if transport:
+                transport.status = FAILED
+            reply = ("error", traceback.format_exc())
+        if transport:
+            transport.close()
+        del kwargs, transport
+        conn.send(reply)
+    conn.close()
+
+class Job:
+    """Handle of a job submitted to a RetrievalPool."""
+    def __init__(self, worker):
+        self.worker = worker
+        self.reply = None
+
+    def done(self, timeout=0):
+        """Whether the job has finished, waiting at most timeout seconds."""
+        return self.reply is not None or self.worker.conn.poll(timeout)
+
+    def result(self):
+        """Wait for the job and return the value returned by its target. If it
+        failed, raise a RuntimeError with the traceback of the worker."""
+        self._receive()
+        status, value = self.reply
+        if status == "error":
+            raise RuntimeError(f"Retrieval failed in the worker process:\n{value}")
+        return value
+
+    def cancel(self):
+        """Stop the job if it is still running, terminating its worker (a new one is
+        started for the next job). The job then fails with "Job cancelled"."""
+        if self.reply is None and not self.done():
+            self.worker.process.terminate()
+            self.worker.process.join()
+            self.reply = ("error", "Job cancelled")
+            self.worker.job = None
+        else:
+            self._receive()
+
+    def _receive(self):
+        if self.reply is None:
+            try:
+                self.reply = self.worker.conn.recv()
+            except EOFError:
+                self.reply = ("error", f"Worker exited with code {self.worker.process.exitcode}")
+            self.worker.job = None
+
+class _Worker:
+    def __init__(self):
+        self.conn, child = mp.Pipe()
+        self.process = mp.Process(target=_serve, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.key = None     # Key of the inputs resident in the process
+        self.job = None     # Job running in it, if any
+
+    def submit(self, key, H, As, target, kwargs):
+        if key is not None and key == self.key:
+            H = As = None   # Only the deltas are sent
+        self.conn.send((key, H, As, target, kwargs))
+        self.key = key
+        self.job = Job(self)
+        return self.job
+
+class RetrievalPool:
+    """Pool of up to n_workers long-lived retrieval processes. They are started
+    on demand and stay alive until shutdown is called (or the main process
+    exits). Jobs go preferably to a worker that already holds their inputs."""
+    def __init__(self, n_workers=1):
+        self.n_workers = n_workers
+        self.workers = []
+
+    def submit(self, target, H, As, key=None, **kwargs):
+        """Run the target ("batched" for multi_batched, "ensemble" for
+        multi_ensemble) on H and As with the given keyword arguments, e.g.
+        niter, phi0, transport... Returns a Job. The job of multi_batched
+        returns the dict {"mses", "alphes"}, the one of multi_ensemble its
+        per seed statistics. The results are written into the transport.
+        key is a cheap token chosen by the caller identifying H and As (e.g.
+        the dataset and the options they were computed from): a worker already
+        holding the inputs of key is not sent them again. Without a key, the
+        inputs are always sent. If every worker is busy, a RuntimeError is
+        raised instead of waiting (see Job.cancel)."""
+        if target not in TARGETS:
+            raise ValueError(f"Unknown target {target}, must be one of {list(TARGETS)}")
+        worker = self._idle_worker(key)
+        return worker.submit(key, H, As, target, kwargs)
+
+    def _idle_worker(self, key):
+        for worker in self.workers:
+            if not worker.process.is_alive():
+                if worker.job is not None:
+                    worker.job._receive()
+                worker.conn.close()
+        self.workers = [worker for worker in self.workers if worker.process.is_alive()]
+        for worker in self.workers:
+            if worker.job is not None and worker.job.done():
+                worker.job._receive()
+        idle = [worker for worker in self.workers if worker.job is None]
+        for worker in idle:
+            if key is not None and worker.key == key:
+                return worker
+        if idle:
+            return idle[0]
+        if len(self.workers) < self.n_workers:
+            # Shared memory must be tracked by the same process in all workers
+            resource_tracker.ensure_running()
+            self.workers.append(_Worker())
+            return self.workers[-1]
+        # Never block the caller (e.g. a GUI) waiting for a job to finish
+        raise RuntimeError("Every worker of the pool is busy, wait for a job or cancel it")
+
+    def shutdown(self, wait=True):
+        """Stop the workers. If wait is False, the workers still running a job
+        are terminated instead of waiting for them."""
+        for worker in self.workers:
+            if worker.job is not None and not worker.job.done() and not wait:
+                worker.process.terminate()
+            else:
+                try:
+                    worker.conn.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+            worker.process.join()
+            worker.conn.close()
+        self.workers = []
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SHARED MEMORY TRANSPORT BETWEEN THE RETRIEVAL PROCESS AND ITS MONITORS
+    A single multiprocessing.shared_memory block holds the result of each
+source, a ring buffer with the MSE of each iteration and a status flag. The
+retrieval process writes into it and the monitors read it through NumPy views,
+so nothing is copied or pickled after the process is started.
+"""
+from multiprocessing import shared_memory
+import weakref
+import numpy as np
+
+# Values of the status flag
+RUNNING = 0
+DONE = 1
+FAILED = 2
+
+# Segments that could not be unmapped yet, as views over them were still alive
+_lingering = []
+
+class SharedTransport:
+    """Result buffers and MSE ring buffer of n_sources sources. The block is
+    created by the process that builds the object; pickling it (e.g. passing it
+    to a mp.Process) attaches the other end to the same block. Only the creator
+    frees it, with close or when it is garbage collected.
+
+    Parameters:
+        - n_sources: Number of sources (components) being retrieved.
+        - shape: Shape (ny, nx) of each result.
+        - capacity: Number of MSE values kept per source. If the iterations
+        exceed it, the oldest values are overwritten.
+    """
+    def __init__(self, n_sources, shape, capacity, name=None):
+        self.n_sources = n_sources
+        self.shape = tuple(shape)
+        self.capacity = capacity
+        ny, nx = self.shape
+        # Layout: result | MSE ring | counts | status
+        sizes = [n_sources*ny*nx*16, capacity*n_sources*8, n_sources*8, 8]
+        offsets = np.cumsum([0]+sizes)
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=int(offsets[-1]))
+            # The block is freed even if close is never called
+            self._unlink = weakref.finalize(self, self.shm.unlink)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        buf = self.shm.buf
+        self.result = np.ndarray((n_sources, ny, nx), np.complex128, buf, offsets[0])
+        self.ring = np.ndarray((capacity, n_sources), np.float64, buf, offsets[1])
+        self.counts = np.ndarray(n_sources, np.int64, buf, offsets[2])
+        self._status = np.ndarray(1, np.int64, buf, offsets[3])
+        if self.owner:
+            self.reset()
+
+    def __reduce__(self):
+        return (SharedTransport, (self.n_sources, self.shape, self.capacity, self.shm.name))
+
+    def reset(self):
+        """Clear the MSE history and mark the transport as running."""
+        self.counts[:] = 0
+        self._status[0] = RUNNING
+
+    @property
+    def status(self):
+        return int(self._status[0])
+
+    @status.setter
+    def status(self, value):
+        self._status[0] = value
+
+    def push(self, source, mse):
+        """Append the MSE of one iteration of source. The value is written
+        before the count is increased, so readers never see unwritten values."""
+        count = self.counts[source]
+        self.ring[count % self.capacity, source] = mse
+        self.counts[source] = count+1
+
+    def history(self, source):
+        """MSE values of source in the ring, oldest first. This is a view
+        of the shared block unless the ring has wrapped around."""
+        count = int(self.counts[source])
+        if count <= self.capacity:
+            return self.ring[:count, source]
+        return np.roll(self.ring[:, source], -(count % self.capacity))
+
+    def close(self):
+        """Unmap the block and, if this end created it, free it. Views taken
+        from the transport must not be used afterwards."""
+        del self.result, self.ring, self.counts, self._status
+        if self.owner:
+            self._unlink()
+        _lingering.append(self.shm)
+        # The mapping stays until every view over it has been released
+        for shm in _lingering[:]:
+            try:
+                shm.close()
+                _lingering.remove(shm)
+            except BufferError:
+                pass
@@ -11,14 +11,15 @@ import tkinter as tk
 import tkinter.ttk as ttk
 from tkinter.filedialog import askdirectory, asksaveasfilename, askopenfilename
 from tkinter.messagebox import showinfo, showerror
-import imageio
-import multiprocessing as mp
 import os
 
 # Functions and widgets
-from .misc.file_selector import get_polarimetric_names_kavan, get_polarimetric_names
+from .misc.file_selector import index_folder
 from .gui.video_processing import propaga_video
-from .algorithm import multi 
+from .algorithm.transport import SharedTransport
+from .algorithm.pool import RetrievalPool
+from .misc.image_loader import ImageLoader
+from .misc.decode_cache import cached_loader
 from .gui.plotsnotebook import PlotsNotebook
 from .gui.beamnotebook import BeamNotebook
 from .gui.menubar import Menubar
@@ -68,7 +69,13 @@ class PhaseRetrieverGUI:
         self.beam_notebook.set_callback("config", "begin", self.begin_phase_retrieval)
         self.parent.protocol("WM_DELETE_WINDOW", self.quit)
 
-        self.processes = None
+        # Threads decoding the images, through the cache of decoded images
+        self.loader = cached_loader()
+        # Long-lived process doing the retrievals, started on the first one
+        self.pool = RetrievalPool()
+        self.job = None
+        self.running = False
+        self.transport = None
         self.zetes = None
 
     def loadset(self, event=None):
@@ -118,24 +125,19 @@ class PhaseRetrieverGUI:
         # Set the configuration entry name
         self.beam_notebook.update_element("config", "current path", self.set_directory)
 
-        # Load all image names
+        # Load all image names, recognizing every naming convention in a single pass
         # TODO: Add selector for fname kind
-        self.names_dict = get_polarimetric_names_kavan(self.set_directory)
-        if not self.names_dict:
-            self.names_dict = get_polarimetric_names(self.set_directory,
-                    ftype="png")
+        index = index_folder(self.set_directory)
+        self.names_dict = index["kavan"] or index["david"]
         self.load_plots()
 
     def load_plots(self, event=None):
         self.zetes = list(self.names_dict.keys())
         self.zetes.sort()
-        self.I = []
         n_pol = 6
-        for i in range(n_pol):
-            im = imageio.imread(self.names_dict[self.zetes[0]][i]).astype(np.int32)
-            if len(im.shape)>2:
-                im = im[:, :, 1]
-            self.I.append(im)
+        # Decode the polarimetric images of the first plane at once
+        names = [self.names_dict[self.zetes[0]][i] for i in range(n_pol)]
+        self.I = self.loader.read_many(names, _to_int32)
         ny, nx = self.I[0].shape
         center = (nx//2, ny//2)
         radius = 25
@@ -247,8 +249,8 @@ class PhaseRetrieverGUI:
                 self.n*.1)
 
     def begin_phase_retrieval(self, event=None):
-        """Begin the phase retrieval process by spawning two different python processes, one for each
-        polarization component."""
+        """Begin the phase retrieval process by spawning a python process that retrieves both
+        polarization components in a single batch."""
         # Blocking the second page of the notebook
         self.beam_notebook.set_state("explorer", "disable")
         if not self.zetes:
@@ -270,11 +272,11 @@ class PhaseRetrieverGUI:
         # Create the amplitudes
         self.Ax = []
         self.Ay = []
-        for z in self.zetes:
-            noms = [self.names_dict[z][i] for i in range(6)]
-            # FIXME: He canviat 2 <-> 0 en noms
-            Ix = imageio.imread(noms[2])[y0:y1, x0:x1]
-            Iy = imageio.imread(noms[0])[y0:y1, x0:x1]
+        # FIXME: He canviat 2 <-> 0 en noms
+        noms = [self.names_dict[z][i] for z in self.zetes for i in (2, 0)]
+        # Only the window of each image is kept after decoding it
+        images = self.loader.read_many(noms, lambda image: np.array(image[y0:y1, x0:x1]))
+        for Ix, Iy in zip(images[::2], images[1::2]):
             self.Ax.append(np.sqrt(Ix))
             self.Ay.append(np.sqrt(Iy))
             
@@ -286,61 +288,44 @@ class PhaseRetrieverGUI:
         self.x = x/self.n*umax
         rho2 = self.x*self.x+self.y*self.y
         wz = np.sqrt(np.complex_(1/self.lamb**2-rho2))  # mm^-1, spatial frequency in the z direction
-        # Check if all images are equally spaced. Work only with equally spaced images.
-        old_delta = self.zetes[1]-self.zetes[0]
-        max_i = 1000 
-        for i in range(len(self.zetes)-1):
-            new_delta = self.zetes[i+1]-self.zetes[i]
-            if new_delta != old_delta:
-                max_i = i
-                break
-        z = old_delta*self.names_dict[0]["scale"]
-
-        H = np.exp(2j*np.pi*z*wz)*self.circ
-        H[:] = fftshift(H)
+        # Transfer function of each gap between consecutive planes. Gaps of equal
+        # length share the same array.
+        scale = self.names_dict[0]["scale"]
+        H = []
+        H_gaps = {}
+        for z0, z1 in zip(self.zetes[:-1], self.zetes[1:]):
+            delta = z1-z0
+            if delta not in H_gaps:
+                H_gaps[delta] = fftshift(np.exp(2j*np.pi*delta*scale*wz)*self.circ)
+            H.append(H_gaps[delta])
         phi_0 = np.zeros((self.n*2, self.n*2))
         self.wz = wz    # FIXME: Dirty hack
 
         # Create MSE lists to hold all values
         self.mse = [[], []]
 
-        # Spawn processess with queues
-        self.queues = [mp.Queue(), mp.Queue()]
-        p1, c1 = mp.Pipe()
-        p2, c2 = mp.Pipe()
-        self.reals = [mp.Array("d", range(0, int((self.n*2)**2))),
-                mp.Array("d", range(0, int((self.n*2)**2)))]
-        self.imags = [mp.Array("d", range(0, int((self.n*2)**2))),
-                mp.Array("d", range(0, int((self.n*2)**2)))]
-        self.processes = \
-                [mp.Process(target=multi, args=(H, niter, phi_0, *(self.Ax[:max_i])), 
-                    kwargs={"queue":self.queues[0], "real":self.reals[0], 
-                        "imag":self.imags[0]}),
-                 mp.Process(target=multi, args=(H, niter, phi_0, *(self.Ay[:max_i])), 
-                    kwargs={"queue":self.queues[1], "real":self.reals[1],
-                        "imag":self.imags[1]})]
-        # Start each process
-        for process in self.processes:
-            process.start()
-
-        # Begin monitorization of each process
-        self.running = True
-        self.monitor_processes()
+        # Send the job to the pool, sharing the MSE and the result of both components
+        # through shared memory
+        if self.job is not None and not self.job.done():
+            # A retrieval still running is replaced by the new one
+            self.job.cancel()
+        if self.transport is not None:
+            self.transport.close()
+        self.transport = SharedTransport(2, (self.n*2, self.n*2), niter)
+        As = np.stack([self.Ax, self.Ay], axis=1)
+        self.job = self.pool.submit("batched", H, As, niter=niter, phi0=phi_0,
+                transport=self.transport)
+
+        # Begin monitorization of the job, unless the monitor of a replaced job is still polling
+        if not self.running:
+            self.running = True
+            self.monitor_processes()
 
     def monitor_processes(self, event=None):
         if self.running:
-            alive = False
-            for i, process in enumerate(self.processes):
-                #FIXME: això pot no acabar mai...
-                full = True
-                while full:
-                    try:
-                        data = self.queues[i].get_nowait()
-                        self.mse[i].append(data)
-                    except:
-                        full = False
-                # Check if alive
-                alive = alive or process.is_alive()
+            # Check if alive
+            alive = not self.job.done()
+            self.mse = [self.transport.history(i) for i in range(2)]
 
             # Update XY mse plot
             self.subplot_notebook.plots["MSE"].plot(0, self.mse[0])
@@ -350,16 +335,16 @@ class PhaseRetrieverGUI:
             # Check again after 20ms or so
             self.parent.after(20, self.monitor_processes)
         else:
-            for i, process in enumerate(self.processes):
-                process.join()
+            try:
+                self.job.result()
+            except RuntimeError as error:
+                showerror(title="Phase retrieval error", message=str(error))
+                return
             # We successfully recovered the phases
             self.recovered_phases = True
             self.beam_notebook.set_state("explorer", "enable")
             # Retrieve the phases
-            self.exphi_x = (np.asarray(self.reals[0])+1j*np.asarray(self.imags[0]))
-            self.exphi_x = self.exphi_x.reshape((2*self.n, 2*self.n))
-            self.exphi_y = np.asarray(self.reals[1])+1j*np.asarray(self.imags[1])
-            self.exphi_y = self.exphi_y.reshape((2*self.n, 2*self.n))
+            self.exphi_x, self.exphi_y = self.transport.result
 
             ny, nx = self.Ax[0].shape
             n = min(ny, nx)
@@ -384,10 +369,12 @@ class PhaseRetrieverGUI:
 
             self.save_results()
 
-            # Irradiance propagator
+            # Irradiance propagator, z in mm: planes closer than a thousandth of a wavelength
+            # are shared
+            self.propagator.z_step = self.lamb*1e-3
             self.propagator.set_fields(self.Ax[0]*dx,
                                        self.Ay[0]*dy,
-                                       self.wz)
+                                       self.wz, self.x, self.y)
             I = self.propagator.propagate_to(0)
             self.subplot_notebook.swap_array(I, self.n, 0, "explorer", vmin=0,
                 vmax=1, cmap="gray")
@@ -406,7 +393,10 @@ class PhaseRetrieverGUI:
         np.savez(path_save, Ax=self.Ax[0], Ay=self.Ay[0], p=self.p)
         # Save the phases
         path_save = os.path.join(result_path, "phases.npz")
-        np.savez(path_save, phi_x=self.dx, phi_y=self.dy, ros=self.r)
+        # The window is saved as ((y0, x0), (y1, x1)) so that the result can be
+        # used to warm start later retrievals
+        x0, y0, x1, y1 = self.rect
+        np.savez(path_save, phi_x=self.dx, phi_y=self.dy, ros=self.r, rect=[[y0, x0], [y1, x1]])
 
     def propagate_z(self, z):
         z_w = z*self.lamb
@@ -446,16 +436,23 @@ class PhaseRetrieverGUI:
     def quit(self, event=None):
         self.parent.quit()
         self.parent.destroy()
-        if self.processes:
-            for process in self.processes:
-                process.join()
-
-def delta_z(nom_pol):
+        self.pool.shutdown(wait=False)
+        self.propagator.close()
+        if self.transport is not None:
+            self.transport.close()
+
+def _to_int32(im):
+    """Single channel of a decoded image, as signed integers."""
+    im = im.astype(np.int32)
+    if len(im.shape)>2:
+        im = im[:, :, 1]
+    return im
+
+def delta_z(nom_pol, loader=None):
     """Calculate the correlation between the X and Y components of a beam."""
-    I = []
-    for nom in nom_pol:
-        # IMPORTANT: Convert to floats or signed ints before proceeding
-        I.append(imageio.imread(nom).astype(np.float_))
+    loader = loader if loader is not None else ImageLoader()
+    # IMPORTANT: Convert to floats or signed ints before proceeding
+    I = loader.read_many(nom_pol, lambda im: im.astype(np.float_))
     delta = np.arctan2(I[4]-I[5], I[2]-I[3])
     return delta
 
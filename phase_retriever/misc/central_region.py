@@ -1,47 +1,44 @@
 import numpy as np
-from scipy.fft import fft2, ifft2, fftshift, ifftshift
 
-def find_rect_region(array: np.ndarray , dim: int):
-    """Find the place where a rectangle of size dim X dim best encapsulates the
-    region with most energy inside array."""
+def summed_area_table(array):
+    """Integral image of array, with a leading row and column of zeros, so that
+    the sum of array[y0:y1, x0:x1] is S[y1, x1]-S[y0, x1]-S[y1, x0]+S[y0, x0]."""
+    ny, nx = array.shape
+    sat = np.zeros((ny+1, nx+1))
+    np.cumsum(array, axis=0, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
+
+def best_windows(array, dims):
+    """For each size in dims, find the window of size dim X dim, inside array,
+    holding the most energy. All the box sums come from a single summed area
+    table. Returns a list with ((y0, x0), (y1, x1), energy) for each dim."""
     try:
         ny, nx = array.shape
     except:
         raise ValueError("Input array must be 2D")
-    # Create an array with a centered rectangle
-    rect = np.zeros((ny, nx), dtype=np.complex_)
-    rect[(ny-dim//2)//2:(ny+dim//2)//2,
-         (nx-dim//2)//2:(nx+dim//2)//2] = 1
-    # Transform both arrays and multiply
-    ft_array = fftshift(fft2(ifftshift(array)))
-    ft_rect =  fftshift(fft2(ifftshift(rect)))
-    ft_convo = ft_rect*ft_array
-    # Inverse transform and find its maximum value
-    convo = fftshift(ifft2(ifftshift(ft_convo)))
-    aconvo = np.real(np.conj(convo)*convo)
-    yloc, xloc = np.where(aconvo==aconvo.max())
-    loc = (yloc[0], xloc[0])
+    sat = summed_area_table(array)
+    windows = []
+    for dim in dims:
+        if not 0 < dim <= min(ny, nx):
+            raise ValueError(f"Window of size {dim} does not fit in an array of shape {array.shape}")
+        # Sum of every dim X dim box, indexed by its top left corner
+        box = sat[dim:, dim:]-sat[:-dim, dim:]
+        box -= sat[dim:, :-dim]
+        box += sat[:-dim, :-dim]
+        y0, x0 = np.unravel_index(np.argmax(box), box.shape)
+        windows.append(((y0, x0), (y0+dim, x0+dim), box[y0, x0]))
+    return windows
 
-    # With the center of the rectangle known, we return its left topmost coordinates
-    # alongside its right bottommost (?) coordinates.
-    x0 = loc[1]-dim//2
-    x1 = loc[1]+dim//2
-    if x0 < 0:
-        x0 = 0
-        x1 = dim
-    elif x1 >= nx:
-        x1 = nx
-        x0 = nx-dim
-    y0 = loc[0]-dim//2
-    y1 = loc[0]+dim//2
-    if y0 < 0:
-        y0 = 0
-        y1 = dim
-    elif y1 >= nx:
-        y1 = nx
-        y0 = nx-dim
-
-    return (y0, x0), (y1, x1)
+def find_rect_region(array: np.ndarray , dim):
+    """Find the place where a rectangle of size dim X dim best encapsulates the
+    region with most energy inside array. Returns its top left and bottom right
+    coordinates, (y0, x0), (y1, x1). If dim is a sequence of sizes, a list with
+    the rectangle of each of them is returned."""
+    if np.ndim(dim):
+        return [(top, bottom) for top, bottom, _ in best_windows(array, dim)]
+    top, bottom, _ = best_windows(array, [dim])[0]
+    return top, bottom
 
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
@@ -56,3 +53,6 @@ if __name__ == "__main__":
     plt.imshow(func); plt.show()
     
     print(find_rect_region(func, dim))
+    # Fraction of the energy inside windows of several sizes, from a single table
+    for top, bottom, energy in best_windows(func, [64, 128, 256, 512]):
+        print(bottom[0]-top[0], top, bottom, energy/func.sum())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CONTAINER FORMAT FOR POLARIMETRIC DATASETS
+    A whole acquisition in a single file: a (planes, 6, ny, nx) stack with the
+polarimetric images of every plane, in their own dtype, preceded by a JSON
+header with the z position and scale of each plane, the dtype and free-form
+metadata. The stack is
+stored raw, aligned to a page, so that np.memmap can slice a region of interest
+without reading the whole frames. Layout:
+
+    MAGIC | header length (uint64, little endian) | JSON header | padding | stack
+
+    python -m phase_retriever.misc.container sims sims.pds --kind png
+"""
+import json
+import os
+import numpy as np
+
+from .file_selector import get_polarimetric_names, get_polarimetric_names_kavan, \
+        get_polarimetric_npz
+from .image_loader import ImageLoader
+
+MAGIC = b"PHRDSET1"
+ALIGN = 4096
+N_POL = 6
+
+# Functions listing the polarimetric sets of each of the naming conventions
+CONVENTIONS = {
+        "png"   : get_polarimetric_names,
+        "kavan" : get_polarimetric_names_kavan,
+        "npz"   : get_polarimetric_npz,
+        }
+
+def _data_offset(header_bytes):
+    n = len(MAGIC)+8+len(header_bytes)
+    return -(-n//ALIGN)*ALIGN
+
+def create_container(path, zetes, shape, scales=None, metadata=None, dtype="<u2"):
+    """Create a container for the planes zetes, with images of the given
+    shape (ny, nx) and dtype, and return its stack as a writable np.memmap of
+    shape (planes, 6, ny, nx). scales gives the scale of each plane (1e-3 by
+    default), and metadata any JSON serializable dict."""
+    ny, nx = shape
+    if scales is None:
+        scales = [1e-3]*len(zetes)
+    # Always little endian on disk
+    dtype = np.dtype(dtype).newbyteorder("<")
+    header = {"zetes": [float(z) for z in zetes], "scales": [float(s) for s in scales],
+            "shape": [len(zetes), N_POL, int(ny), int(nx)], "dtype": dtype.str,
+            "metadata": metadata or {}}
+    header_bytes = json.dumps(header).encode()
+    offset = _data_offset(header_bytes)
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        f.truncate(offset+len(zetes)*N_POL*ny*nx*dtype.itemsize)
+    return np.memmap(path, dtype=dtype, mode="r+", offset=offset, shape=tuple(header["shape"]))
+
+def open_container(path):
+    """Open a container. Returns its header (a dict) and its stack, as a
+    read-only np.memmap of shape (planes, 6, ny, nx)."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a dataset container")
+        length = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+        header_bytes = f.read(length)
+    header = json.loads(header_bytes)
+    stack = np.memmap(path, dtype=header["dtype"], mode="r", offset=_data_offset(header_bytes),
+            shape=tuple(header["shape"]))
+    return header, stack
+
+def get_polarimetric_container(path):
+    """Polarimetric sets of a container, in the format of the functions of
+    file_selector. The images are views of the memory mapped stack."""
+    header, stack = open_container(path)
+    polarimetric_sets = {}
+    for i, (z, scale) in enumerate(zip(header["zetes"], header["scales"])):
+        polarimetric_sets[z] = {pol: stack[i, pol] for pol in range(N_POL)}
+        polarimetric_sets[z]["scale"] = scale
+        polarimetric_sets[z]["f"] = float(z)
+    return polarimetric_sets
+
+def _single_channel(image):
+    # Color images keep the green channel, as the Tk interface does
+    if image.ndim > 2:
+        image = image[:, :, 1]
+    return image
+
+def convert_dataset(folder, path, kind="png", loader=None, metadata=None):
+    """Convert the dataset in folder, following the naming convention kind (see
+    CONVENTIONS), into the container path. The images are decoded one plane at
+    a time, so the whole dataset is never held in memory. The stack takes the
+    dtype of the first image, and every other image must fit in it without
+    losing values."""
+    if kind not in CONVENTIONS:
+        raise ValueError(f"Unknown convention {kind}, must be one of {list(CONVENTIONS)}")
+    loader = loader if loader is not None else ImageLoader()
+    sets = CONVENTIONS[kind](folder)
+    if not sets:
+        raise ValueError(f"Cannot load polarimetric images from {folder}")
+    zetes = sorted(sets)
+    first = _single_channel(loader.read(sets[zetes[0]][0]))
+    metadata = dict(metadata or {}, source=os.path.abspath(folder), convention=kind)
+    stack = create_container(path, zetes, first.shape, [sets[z]["scale"] for z in zetes], metadata,
+            first.dtype)
+    for i, z in enumerate(zetes):
+        images = loader.read_many([sets[z][pol] for pol in range(N_POL)], _single_channel)
+        for pol, image in enumerate(images):
+            if not np.can_cast(image.dtype, stack.dtype):
+                del stack
+                os.remove(path)
+                raise ValueError(f"Image {pol} of plane {z} is {image.dtype}, it does not fit in "
+                        f"the {np.dtype(first.dtype)} of the first image")
+            stack[i, pol] = image
+    stack.flush()
+    del stack
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert a polarimetric dataset into a container")
+    parser.add_argument("folder")
+    parser.add_argument("path")
+    parser.add_argument("--kind", default="png", choices=list(CONVENTIONS))
+    args = parser.parse_args()
+    convert_dataset(args.folder, args.path, args.kind)
+    header, stack = open_container(args.path)
+    print(f"{args.path}: planes {header['zetes']}, stack {stack.shape}")
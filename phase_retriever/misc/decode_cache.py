@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ON-DISK CACHE OF DECODED IMAGES
+    Decoding a PNG/TIFF costs far more than mapping the same pixels from an
+uncompressed .npy file. The first time an image is read, its decoded frame is
+stored in the cache directory; later reads of the same file (same path, size
+and modification time) open the .npy file as a memory map instead. The cache
+is kept under a size cap, evicting the least recently used frames.
+"""
+import hashlib
+import os
+import threading
+import numpy as np
+
+from .image_loader import ImageLoader, read_image
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "phase_retriever", "frames")
+
+class DecodeCache:
+    """Cache of decoded images in directory, of at most max_bytes.
+
+    Parameters:
+        - directory: Folder of the cache, created if needed.
+        - max_bytes: Size cap of the cache. When exceeded, the frames used
+        the longest time ago are removed.
+        - reader: Function decoding a path into an array.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=2**31, reader=read_image):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.reader = reader
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, path):
+        """Name of the cached frame of path, from its path, size and mtime."""
+        st = os.stat(path)
+        text = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def read(self, source):
+        """Decoded image of source, mapped from the cache if it was already
+        decoded. Arrays are returned as they are. It can replace read_image
+        as the reader of an ImageLoader."""
+        if isinstance(source, np.ndarray):
+            return source
+        fname = os.path.join(self.directory, f"{self.key(source)}.npy")
+        try:
+            image = np.load(fname, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            pass
+        else:
+            try:
+                os.utime(fname)     # Mark it as recently used
+            except OSError:
+                pass    # Read-only or shared cache, the frame is still valid
+            return image
+        image = self.reader(source)
+        try:
+            self._store(fname, image)
+        except OSError:
+            pass    # A full or read-only disk must not prevent loading the data
+        return image
+
+    def _store(self, fname, image):
+        tmp = f"{fname}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, image)
+        os.replace(tmp, fname)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used frames until the cache fits in max_bytes."""
+        with self._lock:
+            entries = []
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(".npy"):
+                        st = entry.stat()
+                        entries.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self):
+        """Remove every frame of the cache."""
+        max_bytes, self.max_bytes = self.max_bytes, -1
+        self.evict()
+        self.max_bytes = max_bytes
+
+def cached_loader(max_workers=None, directory=DEFAULT_CACHE_DIR, max_bytes=2**31):
+    """ImageLoader reading through a DecodeCache in directory. Without a directory,
+    or if it cannot be created, the images are decoded every time."""
+    if directory:
+        try:
+            return ImageLoader(max_workers, DecodeCache(directory, max_bytes).read)
+        except OSError:
+            pass
+    return ImageLoader(max_workers)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FFT FRIENDLY WINDOW SIZES
+    The cost of the FFTs of the iterations depends on the prime factors of the
+size of the window: a size with a large prime factor can be several times
+slower than a slightly larger or smaller one. fft_dim moves a requested size to
+a fast one, following a policy, and timed_sizes keeps a table with the measured
+time of the candidate sizes on this machine.
+
+    python -m phase_retriever.misc.fft_size 64 1024
+"""
+import json
+import os
+import platform
+import time
+import numpy as np
+from scipy.fft import fft2, ifft2, next_fast_len
+
+POLICIES = ("nearest", "pad", "crop", "fastest", None)
+DEFAULT_TABLE = os.path.join(os.path.expanduser("~"), ".cache", "phase_retriever", "fft_sizes.json")
+
+def is_fast(n):
+    """Whether n is an even size with only small prime factors, fast for scipy.fft."""
+    return n%2 == 0 and next_fast_len(n) == n
+
+def next_fast_dim(n):
+    """Smallest fast size (see is_fast) not smaller than n."""
+    n = next_fast_len(max(2, int(n)))
+    while n%2:
+        n = next_fast_len(n+1)
+    return n
+
+def prev_fast_dim(n):
+    """Largest fast size (see is_fast) not larger than n, at least 2."""
+    n = max(2, int(n)) & ~1
+    while not is_fast(n):
+        n -= 2
+    return n
+
+def fast_dims(lo, hi):
+    """Fast sizes between lo and hi, both included."""
+    dims = []
+    n = next_fast_dim(lo)
+    while n <= hi:
+        dims.append(n)
+        n = next_fast_dim(n+1)
+    return dims
+
+def time_dims(dims, repeats=5, workers=-1):
+    """Seconds taken by a forward and a backward complex FFT of a dim x dim window,
+    for each of dims, as {dim: seconds}. The best of repeats runs is kept."""
+    timings = {}
+    for n in dims:
+        x = np.ones((n, n), dtype=np.complex128)
+        ifft2(fft2(x, workers=workers), workers=workers)  # Plan it first
+        best = np.inf
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            ifft2(fft2(x, workers=workers), workers=workers)
+            best = min(best, time.perf_counter()-t0)
+        timings[n] = best
+    return timings
+
+def _machine():
+    return f"{platform.node()}-{platform.machine()}-{os.cpu_count()}"
+
+def timed_sizes(lo=64, hi=1024, path=DEFAULT_TABLE, refresh=False):
+    """Table {dim: seconds} with the time of the FFTs of the fast sizes between lo and
+    hi on this machine (see time_dims). The times are kept in the JSON file path, per
+    machine, so that only the sizes not yet timed are measured. Without a path, or if
+    it cannot be written, the table is not kept."""
+    tables = {}
+    if path and not refresh:
+        try:
+            with open(path) as f:
+                tables = json.load(f)
+        except (OSError, ValueError):
+            tables = {}
+    table = {int(n): t for n, t in tables.get(_machine(), {}).items()}
+    missing = [n for n in fast_dims(lo, hi) if n not in table]
+    if missing:
+        table.update(time_dims(missing))
+        tables[_machine()] = {str(n): t for n, t in sorted(table.items())}
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "w") as f:
+                    json.dump(tables, f, indent=1)
+            except OSError:
+                pass
+    return {n: t for n, t in table.items() if lo <= n <= hi}
+
+def fft_dim(dim, policy="nearest", table=None):
+    """Size of the window to use instead of dim, following policy:
+        - "pad": the smallest fast size not smaller than dim.
+        - "crop": the largest fast size not larger than dim.
+        - "nearest": the closest of both, "pad" on ties.
+        - "fastest": the fastest size within dim/8 of dim, according to table
+        ({dim: seconds}, by default timed_sizes around dim).
+        - None: dim itself.
+    """
+    dim = int(dim)
+    if policy is None:
+        return dim
+    if policy == "pad":
+        return next_fast_dim(dim)
+    if policy == "crop":
+        return prev_fast_dim(dim)
+    if policy == "nearest":
+        up, down = next_fast_dim(dim), prev_fast_dim(dim)
+        return up if up-dim <= dim-down else down
+    if policy == "fastest":
+        lo, hi = dim-dim//8, dim+dim//8
+        if table is None:
+            table = timed_sizes(lo, hi)
+        candidates = {n: t for n, t in table.items() if lo <= n <= hi}
+        if not candidates:
+            return fft_dim(dim, "nearest")
+        return min(candidates, key=candidates.get)
+    raise ValueError(f"Unknown policy {policy}, must be one of {list(POLICIES)}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Time the FFTs of the fast window sizes of this machine")
+    parser.add_argument("lo", type=int, nargs="?", default=64)
+    parser.add_argument("hi", type=int, nargs="?", default=1024)
+    parser.add_argument("--refresh", action="store_true")
+    args = parser.parse_args()
+    table = timed_sizes(args.lo, args.hi, refresh=args.refresh)
+    for n, t in sorted(table.items()):
+        print(f"{n:5d} {t*1e3:9.3f} ms")
@@ -6,11 +6,153 @@ FILE SELECTOR FOR POLARIMETRIC IMAGES
 set of properly corrected polarimetric images.
 """
 import os
+import json
 import numpy as np
 import sys
 
-def get_polarimetric_names(folder, pol_keys={0:"a0", 1:"a45", 2:"a90",
-    3:"a135", 4:"aLev", 5:"aDex"}, ftype="png"):
+# Analyzer names of each polarization in each of the naming conventions
+DAVID_KEYS = {0:"a0", 1:"a45", 2:"a90", 3:"a135", 4:"aLev", 5:"aDex"}
+KAVAN_KEYS = {0:"LX", 1:"L45", 2:"LY", 3:"L135", 4:"Q45", 5:"Q135"}
+
+MANIFEST = ".phase_retriever_index.json"
+MANIFEST_VERSION = 1
+
+def parse_david(fname, pol_keys=DAVID_KEYS, ftype="png"):
+    """Plane, polarization and extra fields of a file named
+
+        {beam type}_{z location}_{polarimetric image}.{file type}
+
+    (David's naming convention), or None if it does not follow it."""
+    # Try to get the fname and ftype. If not divisible, get out
+    try:
+        image_name, f_type = fname.split(".")
+    except ValueError:
+        return None
+    # Recognize the filetype and bail out if not the correct one
+    if f_type != ftype:
+        return None
+    fields = image_name.split("_")
+    if len(fields) < 3:
+        return None  # Not a valid filename!
+    # Fields of the analyzer and of the z location
+    pols = [pol for field in fields for pol, key in pol_keys.items() if field == key]
+    zs = [field for field in fields if field.startswith("z")]
+    if not pols or not zs:
+        return None
+    try:
+        z = int(zs[0][1:])
+    except ValueError:
+        return None
+    extra = {"scale": 1e-3}
+    if pols[0] == 0:
+        extra["f"] = float(zs[0][1:])
+    return z, pols[0], extra
+
+def parse_kavan(fname, pol_keys=KAVAN_KEYS, ftype="TIFF"):
+    """Plane, polarization and extra fields of a file following Kavan's naming
+    convention, or None if it does not follow it."""
+    # Try to get the fname and ftype. If not divisible, get out
+    try:
+        image_name, f_type = fname.split(".")
+    except ValueError:
+        return None
+    # Recognize the filetype and bail out if not the correct one
+    if f_type != ftype:
+        return None
+    # Retrieve the necessary information. If not possible, bail out
+    try:
+        image_info, z = image_name.split("Z")
+        z, unit = int(z[:-4]), z[-4:-2]
+    except ValueError:
+        return None
+    pol = [pol for pol, key in pol_keys.items() if image_info[2:] == key]
+    if not pol:
+        return None
+    extra = {"scale": 1 if unit == "mm" else 1e-3}
+    if pol[0] == 0:
+        extra["f"] = float(0)
+    return z, pol[0], extra
+
+# Parsers of the naming conventions recognized by index_folder
+PARSERS = {
+        "david" : parse_david,
+        "kavan" : parse_kavan,
+        }
+
+def scan_folder(folder, parsers=PARSERS):
+    """Polarimetric sets of folder for each of the naming conventions given by
+    parsers, {name: function(fname) -> (z, polarization, extra) or None}, in a
+    single pass over the directory. Returns {name: polarimetric_sets}."""
+    with os.scandir(folder) as it:
+        filenames = sorted(entry.name for entry in it if entry.is_file())
+    index = {name: {} for name in parsers}
+    for fname in filenames:
+        for name, parse in parsers.items():
+            parsed = parse(fname)
+            if parsed is None:
+                continue
+            z, pol, extra = parsed
+            # Check if the dict for the distance already exists
+            polarimetric_sets = index[name]
+            if z not in polarimetric_sets:
+                polarimetric_sets[z] = {}
+            polarimetric_sets[z][pol] = f"{folder}/{fname}"
+            for key, value in extra.items():
+                # The scale of a plane is given by its first file
+                polarimetric_sets[z].setdefault(key, value)
+            break
+    return index
+
+def index_folder(folder, use_manifest=True):
+    """Polarimetric sets of folder for every naming convention of PARSERS,
+    {name: polarimetric_sets}. The index is saved in a manifest beside the data,
+    and reused as long as the modification time of the folder does not change,
+    so that repeated loads skip the scan."""
+    path = os.path.join(folder, MANIFEST)
+    mtime = os.stat(folder).st_mtime_ns
+    if use_manifest:
+        index = _read_manifest(folder, path, mtime)
+        if index is not None:
+            return index
+    index = scan_folder(folder)
+    if use_manifest:
+        try:
+            _write_manifest(folder, path, index)
+        except OSError:
+            pass    # E.g. a read-only archive
+    return index
+
+def _read_manifest(folder, path, mtime):
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("mtime") != mtime:
+        return None
+    # JSON has no integer keys, the sets are stored as lists of pairs
+    index = {}
+    for name, planes in manifest["index"].items():
+        index[name] = {}
+        for z, items in planes:
+            index[name][z] = {key if isinstance(key, str) else int(key):
+                    f"{folder}/{value}" if isinstance(key, int) else value
+                    for key, value in items}
+    return index
+
+def _write_manifest(folder, path, index):
+    planes = {name: [[z, [[key, os.path.basename(value) if isinstance(key, int) else value]
+        for key, value in sets.items()]] for z, sets in polarimetric_sets.items()]
+        for name, polarimetric_sets in index.items()}
+    manifest = {"version": MANIFEST_VERSION, "mtime": None, "index": planes}
+    # Creating the manifest changes the mtime of the folder, but rewriting it does not
+    with open(path, "w") as f:
+        json.dump(manifest, f)
+    manifest["mtime"] = os.stat(folder).st_mtime_ns
+    with open(path, "w") as f:
+        json.dump(manifest, f)
+
+def get_polarimetric_names(folder, pol_keys=DAVID_KEYS, ftype="png"):
     """Return a set of dictionaries containing the set of polarimetric images
     for each family of measurements. Assumes a filename of the form
 
@@ -18,68 +160,10 @@ def get_polarimetric_names(folder, pol_keys={0:"a0", 1:"a45", 2:"a90",
 
     (David's naming convention)
     """
-    filenames = os.listdir(folder)
-    filenames.sort()
-    polarimetric_sets = {}
-    pol_idx = None  # just an initialization
-    z_idx = None  # just an initialization
-    for fname in filenames:
-        # Try to get the fname and ftype. If not divisible, get out
-        try:
-            image_name, f_type = fname.split(".")
-        except:
-            continue
-        # Recognize the filetype and bail out if not the correct one
-        if f_type != ftype:
-            continue
-        # Retrieve the necessary information. If not possible, bail out
-        try:
-            fields = image_name.split("_")
-        except:
-            continue
-
-        if len(fields) < 3:
-            continue  # Not a valid filename!
-
-        # Get the index for the analyzer field
-        if pol_idx is None:
-            for idx, field in enumerate(fields):
-                if field in pol_keys.values():
-                    pol_idx = idx
-                    break
-
-        # Get the index for the z field
-        if z_idx is None:
-            for idx, field in enumerate(fields):
-                if field.startswith("z"):
-                    z_idx = idx
-                    break
-
-        # Check if the dict for the distance already exists
-        z = int(fields[z_idx][1:])
-        complete_fname = f"{folder}/{fname}"
-        if z not in polarimetric_sets:
-            polarimetric_sets[z] = {}
-        if fields[pol_idx] == pol_keys[0]:
-            polarimetric_sets[z][0] = complete_fname
-            polarimetric_sets[z]["f"] = float(fields[z_idx][1:])
-
-        elif fields[pol_idx] == pol_keys[1]:
-            polarimetric_sets[z][1] = complete_fname
-            
-        elif fields[pol_idx] == pol_keys[2]:
-            polarimetric_sets[z][2] = complete_fname
-
-        elif fields[pol_idx] == pol_keys[3]:
-            polarimetric_sets[z][3] = complete_fname
-
-        elif fields[pol_idx] == pol_keys[4]:
-            polarimetric_sets[z][4] = complete_fname
-            
-        elif fields[pol_idx] == pol_keys[5]:
-            polarimetric_sets[z][5] = complete_fname
-        polarimetric_sets[z]["scale"] = 1e-3
-    return polarimetric_sets
+    if pol_keys == DAVID_KEYS and ftype == "png":
+        return index_folder(folder)["david"]
+    parse = lambda fname: parse_david(fname, pol_keys, ftype)
+    return scan_folder(folder, {"david": parse})["david"]
 
 def get_polarimetric_npz(folder, pol_keys={0:"a0", 1:"a45", 2:"a90",
     3:"a135", 4:"aLev", 5:"aDex"}):
@@ -103,60 +187,12 @@ def get_polarimetric_npz(folder, pol_keys={0:"a0", 1:"a45", 2:"a90",
             polarimetric_sets[int(z)][i] = data[pol_keys[i]]
     return polarimetric_sets
 
-def get_polarimetric_names_kavan(folder, ftype="TIFF", pol_keys={0:"LX", 1:"L45", 
-    2:"LY", 3:"L135", 4:"Q45", 5:"Q135"}):
+def get_polarimetric_names_kavan(folder, ftype="TIFF", pol_keys=KAVAN_KEYS):
     """Get the polarimetric image names according to Kavan's naming convention."""
-    filenames = os.listdir(folder)
-    filenames.sort()
-    polarimetric_sets = {}
-    for fname in filenames:
-        # Try to get the fname and ftype. If not divisible, get out
-        try:
-            image_name, f_type = fname.split(".")
-        except:
-            continue
-
-        # Recognize the filetype and bail out if not the correct one
-        if f_type != ftype:
-            continue
-        # Retrieve the necessary information. If not possible, bail out
-        try:
-            fields = []
-            image_info, z = image_name.split("Z")
-            fields.append(image_info[:2])
-            fields.append(image_info[2:])
-            fields.append(z[-4:-2])
-            fields.append(z[:-4])
-        except:
-            continue
-        if len(fields) < 4:
-            continue # Not a valid filename!
-
-        # Check if the dict for the distance already exists
-        z = int(fields[-1])
-        complete_fname = f"{folder}/{fname}"
-        if z not in polarimetric_sets:
-            polarimetric_sets[z] = {}
-            polarimetric_sets[z]["scale"] = 1 if fields[2] == "mm" else 1e-3
-        if fields[1] == pol_keys[0]:
-            polarimetric_sets[z][0] = complete_fname
-            polarimetric_sets[z]["f"] = float(0)
-
-        elif fields[1] == pol_keys[1]:
-            polarimetric_sets[z][1] = complete_fname
-            
-        elif fields[1] == pol_keys[2]:
-            polarimetric_sets[z][2] = complete_fname
-
-        elif fields[1] == pol_keys[3]:
-            polarimetric_sets[z][3] = complete_fname
-
-        elif fields[1] == pol_keys[4]:
-            polarimetric_sets[z][4] = complete_fname
-            
-        elif fields[1] == pol_keys[5]:
-            polarimetric_sets[z][5] = complete_fname
-    return polarimetric_sets
+    if pol_keys == KAVAN_KEYS and ftype == "TIFF":
+        return index_folder(folder)["kavan"]
+    parse = lambda fname: parse_kavan(fname, pol_keys, ftype)
+    return scan_folder(folder, {"kavan": parse})["kavan"]
     
 if __name__ == "__main__":
     folder = "."
@@ -1,8 +1,58 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import numpy as np
-from scipy.fft import fftshift, ifftshift, fft2, ifft2, set_workers
+from scipy.fft import fftshift, ifftshift, fft2, ifft2, ifft, set_workers
+from scipy.signal import CZT
 import multiprocessing as mp
 workers = mp.cpu_count()
 
+def _nbytes(plane):
+    return sum(a.nbytes for a in plane) if isinstance(plane, tuple) else plane.nbytes
+
+class PlaneCache:
+    """Propagated planes, by key, of at most max_bytes. When the budget is exceeded,
+    the planes used the longest time ago are removed."""
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = max_bytes
+        self.planes = OrderedDict()
+        self.nbytes = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.planes
+
+    def get(self, key):
+        """Plane of key, or None if it is not in the cache."""
+        with self._lock:
+            plane = self.planes.get(key)
+            if plane is not None:
+                self.planes.move_to_end(key)
+            return plane
+
+    def put(self, key, plane):
+        with self._lock:
+            if key in self.planes or _nbytes(plane) > self.max_bytes:
+                return
+            self.planes[key] = plane
+            self.nbytes += _nbytes(plane)
+            while self.nbytes > self.max_bytes:
+                _, old = self.planes.popitem(last=False)
+                self.nbytes -= _nbytes(old)
+
+    def clear(self):
+        with self._lock:
+            self.planes.clear()
+            self.nbytes = 0
+
+def _ez_weights(wz, u, v):
+    # See FocalPropagator.ez_weights
+    if u is None:
+        raise ValueError("Transverse frequencies unknown, use create_gamma or give u, v to set_fields")
+    inv = np.zeros(wz.shape, dtype=np.result_type(wz, np.float_))
+    np.divide(1, wz, out=inv, where=np.abs(wz) > 1e-6*np.abs(wz).max())
+    return u*inv, v*inv
+
 class FocalPropagator():
     properties = {
             "Ex"            : None, 
@@ -10,8 +60,27 @@ class FocalPropagator():
             "pixel_size"    : None,
             }
 
-    def __init__(self, Ex=None, Ey=None, wz=None):
-
+    def __init__(self, Ex=None, Ey=None, wz=None, workers=-1, cache_bytes=2**28, z_step=None,
+            prefetch=4):
+        """Propagator of the fields Ex, Ey. The planes it returns are kept in a cache of
+        cache_bytes and, if z_step is given, after each request the next prefetch planes in the
+        direction of the last step are computed in the background. Planes are always computed
+        at the z requested, z_step (in the units of z, e.g. lamb*1e-3 for z in mm) only sets
+        which requests are close enough to share a plane. Without it, only the same z does.
+        workers is the number of FFT threads, -1 for all cores."""
+        self.workers = workers
+        self.cache = PlaneCache(cache_bytes)
+        self.z_step = z_step
+        self.prefetch = prefetch
+        self._executor = None
+        self._pending = {}      # key -> generation of the prefetch computing it
+        self._lock = threading.Lock()
+        self._last = None       # Key and z of the last requested plane
+        self._generation = 0    # Changes with the fields, invalidating prefetches in flight
+        self._done = threading.Event()  # Set at the end of each prefetch
+        self.u = self.v = None  # Transverse frequencies, in the units of wz, giving Ez
+        self._ez_weights = None
+        self._Az = None
         if (isinstance(Ex, np.ndarray) and isinstance(Ey, np.ndarray)):
             self.set_fields(Ex, Ey, wz)
 
@@ -29,42 +98,303 @@ class FocalPropagator():
 
     def propagate_to(self, z):
         if (isinstance(self.Ex, np.ndarray) and isinstance(self.Ey, np.ndarray)):
-            phase = 2j*np.pi*z*self.wz
-            if z < 0:
-                mask = np.real(phase) < 0
-                phase[mask] = -phase[mask]
-            H = np.exp(phase)
-            with set_workers(4):
-                Ex = ifft2(H*self.Ax)
-                Ey = ifft2(H*self.Ay)
-            I = np.real(np.conj(Ex)*Ex)+\
-                np.real(np.conj(Ey)*Ey)
-            I[:] /= self.Imax
-            return I
-
-    def propagate_field_to(self, z):
+            return self._plane("I", z)
+
+    def propagate_field_to(self, z, longitudinal=False):
+        """Fields (Ex, Ey) at z, or (Ex, Ey, Ez) if longitudinal."""
         if (isinstance(self["Ex"], np.ndarray) and isinstance(self["Ey"], np.ndarray)):
-            phase = 2j*np.pi*z*self.wz
-            if z < 0:
-                mask = np.real(phase) < 0
-                phase[mask] = -phase[mask]
-            H = np.exp(phase)
-            with set_workers(4):
-                Ex = ifft2(H*self.Ax)
-                Ey = ifft2(H*self.Ay)
-            return Ex, Ey
-
-    def set_fields(self, Ex, Ey, wz):
-        self.Ex, self.Ey = Ex, Ey
-        with set_workers(4):
-            self.Ax = fft2(Ex)
-            self.Ay = fft2(Ey)
-        self.wz = np.copy(wz)
-        self.wz[:] = fftshift(wz)
-        I = np.real(np.conj(self.Ex)*self.Ex)+\
-            np.real(np.conj(self.Ey)*self.Ey)
+            return self._plane("V" if longitudinal else "E", z)
+
+    def _compute(self, kind, zs):
+        # Irradiances ("I"), pairs of fields ("E") or the three components ("V") at zs, as
+        # read only copies
+        if kind == "I":
+            planes = [np.array(I) for I in self.propagate_stack(zs)]
+        else:
+            stacks = self.propagate_stack(zs, fields=True, longitudinal=kind == "V")
+            planes = [tuple(np.array(E) for E in plane) for plane in zip(*stacks)]
+        for plane in planes:
+            for a in (plane if isinstance(plane, tuple) else (plane,)):
+                a.flags.writeable = False
+        return planes
+
+    def _plane(self, kind, z):
+        """Plane of kind at z from the cache, waiting for it if it is being prefetched, or
+        computed right away. The planes returned are read only."""
+        key = self._key(kind, z)
+        plane = self.cache.get(key)
+        if plane is None:
+            with self._lock:
+                pending = self._pending.get(key) == self._generation
+            if pending:
+                self._wait(key)
+                plane = self.cache.get(key)
+        if plane is None:
+            plane = self._compute(kind, [z])[0]
+            self.cache.put(key, plane)
+        self._schedule(key, z)
+        return plane
+
+    def _key(self, kind, z):
+        return (kind, float(z) if self.z_step is None else int(round(z/self.z_step)))
+
+    def _wait(self, key):
+        while True:
+            with self._lock:
+                if self._pending.get(key) != self._generation:
+                    return
+                event = self._done
+            event.wait()
+
+    def _schedule(self, key, z):
+        # Prefetch the planes following z, in the direction the user is moving. Without z_step
+        # they would hardly ever be requested at exactly the same z
+        last, self._last = self._last, (key, z)
+        if not self.prefetch or self.z_step is None or last is None or last[0][0] != key[0] \
+                or last[0][1] == key[1]:
+            return
+        step = z-last[1]
+        with self._lock:
+            planes = {}
+            for k in range(1, self.prefetch+1):
+                zk = z+step*k
+                planes.setdefault(self._key(key[0], zk), zk)
+            planes = {k: zk for k, zk in planes.items()
+                    if k not in self.cache and k not in self._pending}
+            if not planes:
+                return
+            for k in planes:
+                self._pending[k] = self._generation
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._executor.submit(self._prefetch, list(planes), list(planes.values()),
+                self._generation)
+
+    def _prefetch(self, keys, zs, generation):
+        try:
+            if generation == self._generation:
+                planes = self._compute(keys[0][0], zs)
+                with self._lock:
+                    if generation == self._generation:
+                        for key, plane in zip(keys, planes):
+                            self.cache.put(key, plane)
+        finally:
+            with self._lock:
+                for key in keys:
+                    if self._pending.get(key) == generation:
+                        del self._pending[key]
+                done, self._done = self._done, threading.Event()
+            done.set()
+
+    def invalidate(self):
+        """Forget the cached planes, e.g. after changing the fields."""
+        self._update()
+
+    def _update(self, **attributes):
+        # Set the attributes holding the fields and forget everything computed from the old ones,
+        # in a single step for the prefetch thread
+        with self._lock:
+            for name, value in attributes.items():
+                setattr(self, name, value)
+            self._generation += 1
+            self._pending.clear()
+            self._last = None
+            self._ez_weights = None
+            self._Az = None
+            self.cache.clear()
+            done, self._done = self._done, threading.Event()
+        done.set()
+
+    def close(self):
+        """Stop the background prefetching."""
+        self.invalidate()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def ez_weights(self):
+        """Spectral weights (wu, wv) such that the spectrum of Ez is wu*Ax+wv*Ay, from the
+        transversality of each plane wave: u/wz and v/wz. They are zero where wz vanishes (at
+        the edge of the propagating waves, and beyond it if wz is real). Kept until the fields
+        change."""
+        with self._lock:
+            weights, generation = self._ez_weights, self._generation
+            frequencies = (self.wz, self.u, self.v)
+        if weights is None:
+            weights = _ez_weights(*frequencies)
+            with self._lock:
+                # Unless the fields changed meanwhile
+                if generation == self._generation:
+                    self._ez_weights = weights
+        return weights
+
+    def _spectra(self, longitudinal=False):
+        # Spectra of Ex, Ey and, if longitudinal, Ez, stacked. The fields are read at once, as
+        # the ones of a single generation
+        with self._lock:
+            Ax, Ay, Az, weights = self.Ax, self.Ay, self._Az, self._ez_weights
+            frequencies = (self.wz, self.u, self.v)
+            generation = self._generation
+        if not longitudinal:
+            return np.stack((Ax, Ay))
+        if Az is None:
+            if weights is None:
+                weights = _ez_weights(*frequencies)
+            Az = weights[0]*Ax+weights[1]*Ay
+            with self._lock:
+                if generation == self._generation:
+                    self._ez_weights, self._Az = weights, Az
+        return np.stack((Ax, Ay, Az))
+
+    def _transfer(self, z):
+        phase = 2j*np.pi*z*self.wz
+        if z < 0:
+            mask = np.real(phase) < 0
+            phase[mask] = -phase[mask]
+        return np.exp(phase)
+
+    def _transfer_chunks(self, zs, buf):
+        """Fill buf, shape (chunk, ny, nx), with the transfer functions of the planes zs, a
+        chunk at a time. Yields (start, stop, Hs), Hs being those of zs[start:stop]."""
+        # Equally spaced planes on one side of the focal plane only need the exponential of the
+        # first plane of each chunk and of the step between planes, the rest are products
+        steps = np.diff(zs)
+        one_side = (zs >= 0).all() or (zs <= 0).all()
+        incremental = one_side and steps.size > 0 and np.allclose(steps, steps[0])
+        if incremental:
+            # On each side, _transfer flips the same evanescent waves at every z, so that they
+            # decay: the transfer function is exp(2i*pi*z*w) with a single w for all the planes
+            w = self.wz
+            if (zs < 0).any() and np.iscomplexobj(w):
+                w = np.where(np.imag(w) < 0, -w, w)
+            step = np.exp(2j*np.pi*steps[0]*w)
+        chunk = len(buf)
+        for start in range(0, zs.size, chunk):
+            stop = min(start+chunk, zs.size)
+            Hs = buf[:stop-start]
+            for k, z in enumerate(zs[start:stop]):
+                if incremental and k > 0:
+                    np.multiply(Hs[k-1], step, out=Hs[k])
+                else:
+                    Hs[k] = self._transfer(z)
+            yield start, stop, Hs
+
+    def propagate_stack(self, zs, chunk=16, fields=False, longitudinal=False):
+        """Propagate to every plane of zs at once. The planes are computed in groups of
+        chunk, each with a single batched inverse FFT of both components, and of Ez too if
+        longitudinal (see ez_weights).
+        Output:
+            - I: Irradiance at each plane, normalized as in propagate_to, shape (len(zs), ny, nx).
+            With longitudinal, it includes |Ez|^2. If fields is True, the fields (Ex, Ey), or
+            (Ex, Ey, Ez) if longitudinal, each of shape (len(zs), ny, nx), instead.
+        """
+        zs = np.asarray(zs, dtype=np.float_)
+        A = self._spectra(longitudinal)
+        nc, ny, nx = A.shape
+        if fields:
+            Es = [np.empty((zs.size, ny, nx), dtype=np.complex_) for _ in range(nc)]
+        else:
+            I = np.empty((zs.size, ny, nx), dtype=np.float_)
+        buf = np.empty((min(chunk, zs.size), nc, ny, nx), dtype=np.complex_)
+        for start, stop, Hs in self._transfer_chunks(zs, buf[:, 0]):
+            out = buf[:stop-start]
+            np.multiply(Hs[:, np.newaxis], A, out=out)
+            out = ifft2(out, workers=self.workers, overwrite_x=True)
+            if fields:
+                for c, E in enumerate(Es):
+                    E[start:stop] = out[:, c]
+            else:
+                # Sum of |E|^2 over the components
+                Ik = I[start:stop]
+                np.multiply(out.real[:, 0], out.real[:, 0], out=Ik)
+                Ik += out.imag[:, 0]*out.imag[:, 0]
+                for c in range(1, nc):
+                    Ik += out.real[:, c]*out.real[:, c]
+                    Ik += out.imag[:, c]*out.imag[:, c]
+        if fields:
+            return tuple(Es)
+        I /= self.Imax
+        return I
+
+    def axial_slice(self, axis, index, zs, chunk=16, fields=False, longitudinal=False):
+        """Meridional slice of the beam: the line along axis ("x" or "y") through the pixel
+        index of the other axis, at every plane of zs. Only that line is computed: the inverse
+        transform along the other axis is folded into the spectra, so each plane costs a sum
+        over the spectrum and a 1D inverse FFT instead of a whole 2D one.
+        Output:
+            - I: Irradiance along the line at each plane, normalized as in propagate_to,
+            shape (len(zs), n). If fields is True, the fields (Ex, Ey) instead. Ez is included
+            if longitudinal, as in propagate_stack.
+        """
+        axis = {"y": 0, "x": 1}.get(axis, axis)
+        if axis not in (0, 1):
+            raise ValueError("axis must be x or y")
+        zs = np.asarray(zs, dtype=np.float_)
+        A = self._spectra(longitudinal)
+        nc, ny, nx = A.shape
+        if axis == 1:
+            # Inverse DFT along y evaluated at the row index only
+            A *= (np.exp(2j*np.pi*np.arange(ny)*index/ny)/ny)[:, np.newaxis]
+            subscripts = "zyx,cyx->zcx"
+            n = nx
+        else:
+            A *= np.exp(2j*np.pi*np.arange(nx)*index/nx)/nx
+            subscripts = "zyx,cyx->zcy"
+            n = ny
+        lines = np.empty((zs.size, nc, n), dtype=np.complex_)
+        buf = np.empty((min(chunk, zs.size), ny, nx), dtype=np.complex_)
+        for start, stop, Hs in self._transfer_chunks(zs, buf):
+            np.einsum(subscripts, Hs, A, out=lines[start:stop])
+        lines = ifft(lines, workers=self.workers, overwrite_x=True)
+        if fields:
+            return tuple(lines[:, c] for c in range(nc))
+        I = np.real(np.conj(lines)*lines).sum(axis=1)
+        I /= self.Imax
+        return I
+
+    def propagate_roi(self, z, center, extent, samples, fields=False, longitudinal=False):
+        """Propagate to z, evaluating the result only on a window centered at center (y, x),
+        of size extent (height, width), both in pixels of the fields and possibly fractional,
+        sampled with samples (my, mx) points. extent and samples may be single numbers for
+        square windows. The band limited interpolation of the whole plane is evaluated with a
+        chirp-z transform along each axis, so the cost follows the size of the window, not the
+        one of the equivalent zero padded field.
+        Output:
+            - I: Irradiance on the window, normalized as in propagate_to, shape (my, mx). If
+            fields is True, the fields (Ex, Ey) instead. Ez is included if longitudinal, as in
+            propagate_stack.
+        """
+        ny, nx = self.Ax.shape
+        extent = np.broadcast_to(np.asarray(extent, dtype=np.float_), (2,))
+        samples = np.broadcast_to(np.asarray(samples, dtype=int), (2,))
+        # Spectra at z, centered: index i stands for the frequency i-n//2
+        S = fftshift(self._spectra(longitudinal)*self._transfer(z), axes=(-2, -1))
+        for axis, n, c, e, m in zip((-2, -1), (ny, nx), center, extent, samples):
+            # Points c+(k-m//2)*d, k = 0...m-1, where the sum over i of S_i exp(2i*pi*(i-n//2)*x/n)
+            # is a chirp-z transform along the circle, with an extra phase for the shifted index
+            d = e/m
+            x = c+(np.arange(m)-m//2)*d
+            czt = CZT(n, m, w=np.exp(2j*np.pi*d/n), a=np.exp(-2j*np.pi*x[0]/n))
+            shape = [1, 1, 1]
+            shape[axis] = m
+            S = czt(S, axis=axis)*(np.exp(-2j*np.pi*(n//2)*x/n)/n).reshape(shape)
+        if fields:
+            return tuple(S)
+        I = np.real(np.conj(S)*S).sum(axis=0)
+        I /= self.Imax
+        return I
+
+    def set_fields(self, Ex, Ey, wz, u=None, v=None):
+        """Fields Ex, Ey and the spectral frequency wz, centered. The transverse frequencies u, v
+        (centered, in the units of wz) are only needed for Ez."""
+        with set_workers(self.workers):
+            Ax = fft2(Ex)
+            Ay = fft2(Ey)
+        I = np.real(np.conj(Ex)*Ex)+\
+            np.real(np.conj(Ey)*Ey)
         # Maximum intensity so as to normalize the output values
-        self.Imax = I.max()
+        self._update(Ex=Ex, Ey=Ey, Ax=Ax, Ay=Ay, wz=fftshift(wz), Imax=I.max(),
+                u=None if u is None else fftshift(u), v=None if v is None else fftshift(v))
 
     def create_gamma(self):
         # p_size in terms of wavelength
@@ -78,11 +408,13 @@ class FocalPropagator():
         y, x = np.mgrid[-ny//2:ny//2, -nx//2:nx//2]
         umax = .5/p_size
         beta = y/y.max()*umax
-        alpha = y/y.max()*umax
+        alpha = x/x.max()*umax
         
         theta2 = alpha*alpha + beta*beta
-        self.wz = np.zeros((ny, nx), dtype=np.float_)
-        np.sqrt(1-theta2, where=theta2 < 1, out=self.wz)
+        wz = np.zeros((ny, nx), dtype=np.float_)
+        np.sqrt(1-theta2, where=theta2 < 1, out=wz)
+        # In the frequency ordering of fft2, as the spectra
+        self._update(wz=fftshift(wz), u=fftshift(alpha), v=fftshift(beta))
 
     def create_spectra(self):
         Ex, Ey = self["Ex"], self["Ey"]
@@ -92,9 +424,10 @@ class FocalPropagator():
         I = np.real(np.conj(Ex)*Ex)+\
             np.real(np.conj(Ey)*Ey)
         # Maximum intensity so as to normalize the output values
-        self.Imax = I.max()
+        Imax = I.max()
 
         # Compute the spectra
-        with set_workers(4):
-            self.Ax = fft2(Ex)
-            self.Ay = fft2(Ey)
+        with set_workers(self.workers):
+            Ax = fft2(Ex)
+            Ay = fft2(Ey)
+        self._update(Imax=Imax, Ax=Ax, Ay=Ay)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LAZY STORE OF THE IMAGES OF A POLARIMETRIC DATASET
+    Nothing is decoded when the store is created. Full frames are decoded on
+demand and not kept; once a window (rect) is selected, only the region of
+interest of each image is kept, at the native bit depth of the camera, and the
+converted copies (e.g. to float32) are memoized. The images needed at once
+are decoded concurrently by an ImageLoader.
+"""
+from collections.abc import Mapping
+import numpy as np
+
+from .image_loader import ImageLoader
+
+class ImageStore(Mapping):
+    """Mapping from each plane z to its polarimetric set, as given by the
+    functions of file_selector, with lazy access to the images.
+
+    Parameters:
+        - polarimetric_sets: Dict {z: {polarization: path or array, ...}}.
+        - loader: ImageLoader used to decode the images. By default, a new one
+        with the default number of threads.
+    """
+    def __init__(self, polarimetric_sets, loader=None):
+        self.sets = polarimetric_sets
+        self.loader = loader if loader is not None else ImageLoader()
+        self.rect = None
+        self._rois = {}         # (z, polarization) -> ROI at native bit depth
+        self._converted = {}    # (z, polarization, dtype) -> converted ROI
+
+    def __getitem__(self, z):
+        return self.sets[z]
+
+    def __iter__(self):
+        return iter(self.sets)
+
+    def __len__(self):
+        return len(self.sets)
+
+    def polarizations(self, z):
+        """Polarizations measured at plane z."""
+        return [pol for pol in self.sets[z] if type(pol) == int]
+
+    def full(self, z, pol):
+        """Full frame of polarization pol at plane z. It is decoded at each call."""
+        return self.loader.read(self.sets[z][pol])
+
+    def full_plane(self, z):
+        """Full frames of every polarization at plane z, {polarization: image},
+        decoded concurrently."""
+        pols = self.polarizations(z)
+        return dict(zip(pols, self.loader.read_many(self.sets[z][pol] for pol in pols)))
+
+    def set_rect(self, rect):
+        """Select the region of interest ((y0, x0), (y1, x1)). The ROIs of a
+        previous window are discarded."""
+        rect = tuple(tuple(int(c) for c in corner) for corner in rect)
+        if rect != self.rect:
+            self.rect = rect
+            self._rois = {}
+            self._converted = {}
+
+    def roi(self, z, pol, dtype=None):
+        """Region of interest of polarization pol at plane z, converted to dtype
+        if given. Both the ROI and its converted copies are kept."""
+        key = (z, pol)
+        if key not in self._rois:
+            self.prefetch([z], [pol])
+        image = self._rois[key]
+        if dtype is None or image.dtype == dtype:
+            return image
+        key = (z, pol, np.dtype(dtype))
+        if key not in self._converted:
+            self._converted[key] = image.astype(dtype)
+        return self._converted[key]
+
+    def prefetch(self, zetes=None, pols=None):
+        """Decode concurrently the ROIs not yet kept of the planes zetes (all
+        of them by default) and the polarizations pols (all by default)."""
+        keys = [(z, pol) for z in (self.sets if zetes is None else zetes)
+                for pol in (self.polarizations(z) if pols is None else pols)
+                if (z, pol) not in self._rois]
+        if self.rect is None:
+            raise ValueError("Region of interest not yet selected")
+        (y0, x0), (y1, x1) = self.rect
+        # Copy the ROI in the decoding thread, so that the full frame can be freed
+        crop = lambda image: np.array(image[y0:y1, x0:x1])
+        images = self.loader.read_many([self.sets[z][pol] for z, pol in keys], crop)
+        self._rois.update(zip(keys, images))
+
+    def cropped(self, dtype=None):
+        """Mapping {z: {polarization: ROI}} over the whole dataset, decoding
+        the ROIs of a plane the first time it is accessed."""
+        return CroppedView(self, dtype)
+
+class CroppedView(Mapping):
+    """Cropped images of an ImageStore, see ImageStore.cropped."""
+    def __init__(self, store, dtype=None):
+        self.store = store
+        self.dtype = dtype
+
+    def __getitem__(self, z):
+        store = self.store
+        store.prefetch([z])
+        return {pol: store.roi(z, pol, self.dtype) for pol in store.polarizations(z)}
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
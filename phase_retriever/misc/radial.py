@@ -1,32 +1,80 @@
+from functools import lru_cache
 import numpy as np
 
-def get_function_radius(array, tol=1e-4):
-    """
-    Get a first estimation of the radius of the function defined in array.
-    To do so, we assume functions with radial symmetry and check whether
-    there exist some value smaller than V = array.max()*tol. If it
-    exists, we return the distance from that point to the origin. If not,
-    the function returns None.
-    """
-    vmax = array.max()*tol
-    # FIXME: We just do a quick check by collapsing to a single dimension the array...
+@lru_cache(maxsize=16)
+def _radius_index(ny, nx):
+    """Radius (rounded to the nearest pixel) of each pixel, flattened, measured from the
+    center (ny//2, nx//2) of the array, and the number of pixels of each radius."""
+    y, x = np.ogrid[-(ny//2):ny-ny//2, -(nx//2):nx-nx//2]
+    index = np.rint(np.sqrt(y*y+x*x)).astype(np.intp).ravel()
+    counts = np.bincount(index)
+    index.flags.writeable = False
+    counts.flags.writeable = False
+    return index, counts
+
+def radial_profile(array):
+    """Mean of array over each ring of radius 0, 1, 2... pixels around its center
+    (ny//2, nx//2), where fftshift places the origin of a spectrum. Only the rings
+    fully inside the array are returned."""
     try:
         ny, nx = array.shape
-    except:
+    except ValueError:
         raise ValueError("Input array must be 2D.")
+    index, counts = _radius_index(ny, nx)
+    profile = np.bincount(index, weights=np.asarray(array, dtype=float).ravel())/counts
+    return profile[:min(ny, nx)//2]
 
-    if ny > nx:
-        sg_array = np.mean(array, axis=0)
-        r0 = ny//2
+def estimate_radius(array, tol=1e-4, gap=3):
+    """
+    Estimate the radius of the support of a function with radial symmetry, given
+    centered in array: the radius where its radial mean falls below V = array.max()*tol
+    for good, with sub-pixel precision.
+    Parameters:
+        - array: 2D array, e.g. a power spectrum after fftshift.
+        - tol: Threshold, relative to the maximum of array.
+        - gap: Dips below V of up to gap rings (e.g. zeros of the spectrum) are
+        considered part of the support.
+    Output:
+        - radius: Radius in pixels, interpolated between the last ring above V and
+        the next one. If the radial mean never stays below V for gap+1 rings, the
+        best effort: the last crossing of V, or the edge of the array if there is
+        none. None only if no ring is above V.
+        - confidence: Fraction of the rings beyond the radius which stay below V,
+        at least gap+1 of them (rings beyond the edge count as above), between 0
+        and 1. Low values mean that the function does not decay to a clean floor,
+        e.g. noise level close to V, or that its support reaches the edge.
+    """
+    profile = radial_profile(array)
+    vmax = array.max()*tol
+    below = profile <= vmax
+    if below.all():
+        return None, 0.
+    first = np.argmin(below)
+    # First run of gap+1 consecutive rings below V after the first one above it
+    runs = np.convolve(below[first:], np.ones(gap+1, dtype=int), mode="valid")
+    ends = np.flatnonzero(runs == gap+1)
+    if ends.size:
+        k = first+ends[0]
     else:
-        sg_array = np.mean(array, axis=-1)
-        r0 = nx//2
+        # No clean floor, the last ring where the profile falls below V
+        crossings = np.flatnonzero(below[first+1:] & ~below[first:-1])
+        if not crossings.size:
+            return float(profile.size-1), 0.
+        k = first+1+crossings[-1]
+    # Linear interpolation of the crossing of V between rings k-1 and k
+    radius = k-1+(profile[k-1]-vmax)/(profile[k-1]-profile[k])
+    confidence = below[k:].sum()/max(profile.size-k, gap+1)
+    return float(radius), float(confidence)
 
-    mask = sg_array > vmax
-    radius = np.argwhere(mask)[0]
-    
-    if radius:
-        return abs(radius[0]-r0)
+def get_function_radius(array, tol=1e-4):
+    """
+    Get a first estimation of the radius of the function defined in array.
+    To do so, we assume functions with radial symmetry and look for the radius
+    where the radial mean of array falls below V = array.max()*tol
+    (see estimate_radius), or its best estimate. If no part of the function
+    is above V, the function returns None.
+    """
+    return estimate_radius(array, tol)[0]
 
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
@@ -40,8 +88,8 @@ if __name__ == "__main__":
     fun = np.exp(-(ny*ny+nx*nx)*.5/sigma**2)*np.sin(5*phi)
     fun *= fun
 
-    r = get_function_radius(fun)
-    print(f"Expected: True  === Got: {True if r else False}")
+    r, confidence = estimate_radius(fun)
+    print(f"Expected: True  === Got: {True if r else False} (r = {r:.2f}, confidence {confidence:.2f})")
     fig, ax = plt.subplots()
     plt.imshow(fun, cmap="gray")
     circ = Circle((n//2, n//2), r, alpha=0.2)
@@ -50,7 +98,8 @@ if __name__ == "__main__":
     sigma = 256
     fun = np.exp(-(ny*ny+nx*nx)*.5/sigma**2)
 
-    r = get_function_radius(fun)
-    print(f"Expected: False === Got: {True if r else False}")
+    # Support beyond the edge, only a best effort
+    r, confidence = estimate_radius(fun)
+    print(f"Expected: low confidence === Got: r = {r:.2f}, confidence {confidence:.2f}")
 
     plt.show()
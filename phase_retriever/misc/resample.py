@@ -0,0 +1,43 @@
+import numpy as np
+from scipy.fft import fft2, ifft2, fftshift, ifftshift
+
+from .fft_size import next_fast_dim
+
+def fourier_resample(field, shape):
+    """Resample the 2D complex field to the given shape by cropping or zero
+    padding its spectrum around the zero frequency. The physical extent of the
+    field is kept, so its sampling changes by the ratio between the shapes. A
+    stack of fields, shape (..., ny, nx), is resampled along its last two axes."""
+    ny, nx = field.shape[-2:]
+    my, mx = shape
+    if (ny, nx) == (my, mx):
+        return np.array(field, dtype=np.complex_)
+    axes = (-2, -1)
+    ft = fftshift(fft2(field, axes=axes), axes=axes)
+    ft_new = np.zeros(field.shape[:-2]+(my, mx), dtype=np.complex_)
+    cy, cx = min(ny, my), min(nx, mx)
+    # Both spectra are centered at n//2 after the shift
+    ft_new[..., my//2-cy//2:my//2-cy//2+cy, mx//2-cx//2:mx//2-cx//2+cx] = \
+            ft[..., ny//2-cy//2:ny//2-cy//2+cy, nx//2-cx//2:nx//2-cx//2+cx]
+    return ifft2(ifftshift(ft_new, axes=axes), axes=axes)*(my*mx)/(ny*nx)
+
+def reduced_dim(dim, bandwidth, guard=4):
+    """Smallest even size, fast for the FFT, of a grid with the same extent as a
+    dim x dim window holding the spectrum of the irradiance of a field with the
+    given bandwidth (twice it), plus guard frequency pixels. It is never larger
+    than dim."""
+    return min(next_fast_dim(np.ceil(2*(2*bandwidth+guard))), dim)
+
+def recrop(field, rect, new_rect, fill=1):
+    """Move field, which covers the window rect = ((y0, x0), (y1, x1)) of the
+    sensor, to the window new_rect of the same sensor. The region of new_rect not
+    covered by rect is filled with fill."""
+    (y0, x0), (y1, x1) = rect
+    (v0, u0), (v1, u1) = new_rect
+    cropped = np.full((v1-v0, u1-u0), fill, dtype=field.dtype)
+    # Overlap between both windows, in sensor coordinates
+    t, l = max(y0, v0), max(x0, u0)
+    b, r = min(y1, v1), min(x1, u1)
+    if t < b and l < r:
+        cropped[t-v0:b-v0, l-u0:r-u0] = field[t-y0:b-y0, l-x0:r-x0]
+    return cropped
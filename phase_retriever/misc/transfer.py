@@ -0,0 +1,65 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from scipy.fft import fftshift, ifftshift
+
+# Transfer functions already computed, by their arguments, least recently used first
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+CACHE_BYTES = 2**28
+
+def transfer_function(dim, pixel_size, lamb, dz, bandwidth):
+    """Free space transfer function for a propagation of dz, restricted to the
+    circle of radius bandwidth (in frequency pixels) and in the frequency
+    ordering of fft2. Pixel size, distance and wavelength must be in the same
+    units. The result is cached, up to CACHE_BYTES in total, so runs sharing the
+    same optics reuse it. It is returned as a read only array, copy it before
+    modifying it."""
+    key = (dim, pixel_size, lamb, dz, bandwidth)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    H = _transfer_function(*key)
+    with _cache_lock:
+        _cache[key] = H
+        total = sum(h.nbytes for h in _cache.values())
+        while total > CACHE_BYTES and len(_cache) > 1:
+            _, old = _cache.popitem(last=False)
+            total -= old.nbytes
+    return H
+
+def _transfer_function(dim, pixel_size, lamb, dz, bandwidth):
+    p_size = pixel_size/lamb
+    ny, nx = np.mgrid[-dim//2:dim//2, -dim//2:dim//2]
+    bandwidth_mask = (ny*ny+nx*nx < bandwidth*bandwidth)
+    umax = .5/p_size
+    x = nx/nx.max()*umax
+    y = ny/ny.max()*umax
+    rho2 = x*x+y*y
+    gamma = np.zeros((dim, dim), dtype=np.float_)
+    np.sqrt(1-rho2, out=gamma, where=bandwidth_mask)
+    H = np.exp(2j*np.pi*gamma*dz/lamb)
+    # Remove all values of H lying outside the bandwidth of the beam
+    H[:] = fftshift(H*bandwidth_mask)
+    H.flags.writeable = False
+    return H
+
+def crop_spectrum(H, m):
+    """Central m x m frequencies of H, both in the frequency ordering of fft2. It is
+    the same function on a grid of m points with the same extent."""
+    n = H.shape[0]
+    s = n//2-m//2
+    H = ifftshift(fftshift(H)[s:s+m, s:s+m])
+    H.flags.writeable = False
+    return H
+
+def gap_transfer_functions(dim, pixel_size, lamb, zetes, bandwidth, grid=None):
+    """List with the transfer function between each pair of consecutive planes
+    located at the distances zetes. If grid is smaller than dim, they are cropped
+    to the central grid x grid frequencies (see crop_spectrum)."""
+    Hs = [transfer_function(dim, pixel_size, lamb, z1-z0, bandwidth)
+            for z0, z1 in zip(zetes[:-1], zetes[1:])]
+    if grid is not None and grid < dim:
+        Hs = [crop_spectrum(H, grid) for H in Hs]
+    return Hs
@@ -1,13 +1,23 @@
+from functools import lru_cache
+import itertools
+import warnings
 import numpy as np
-from scipy.fft import fft2, ifft2, fftshift, ifftshift
-import multiprocessing as mp
-import imageio
+from scipy.fft import fft2, ifft2, fftshift, ifftshift, rfft2, irfft2
 
-from .algorithm import multi
-from .misc.radial import get_function_radius
+from .algorithm import PRECISIONS, ACCELERATORS
+from .algorithm.checkpoint import load_checkpoint
+from .algorithm.transport import SharedTransport
+from .algorithm.pool import RetrievalPool
+from .misc.radial import estimate_radius
 from .misc.file_selector import get_polarimetric_names, get_polarimetric_npz
+from .misc.container import get_polarimetric_container
 from .misc.central_region import find_rect_region
 from .misc.stokes import get_stokes_parameters
+from .misc.transfer import gap_transfer_functions
+from .misc.fft_size import fft_dim, POLICIES
+from .misc.resample import fourier_resample, recrop, reduced_dim
+from .misc.image_store import ImageStore
+from .misc.decode_cache import cached_loader, DEFAULT_CACHE_DIR
 
 def bound_rect_to_im(shape, rect):
     """Return correct rect coordinates, bound to the physical limits given by shape."""
@@ -32,38 +42,80 @@ def bound_rect_to_im(shape, rect):
 
     return (x0, y0), (x1, y1)
 
+@lru_cache(maxsize=8)
+def _lowpass_mask(ny, nx, bw):
+    """Circular mask of radius bw over the half spectrum given by rfft2, in unshifted
+    order. On the Nyquist lines, where the full mask is not symmetric, it takes the mean
+    of both halves, so that filtering stays the real part of the complex filter."""
+    fy = np.fft.fftfreq(ny, 1/ny)
+    fx = np.fft.fftfreq(nx, 1/nx)
+    mask = (fy[:, np.newaxis]**2+fx**2 < bw*bw).astype(float)
+    mask = .5*(mask+np.roll(mask[::-1, ::-1], 1, axis=(0, 1)))
+    mask = mask[:, :nx//2+1].copy()
+    mask.flags.writeable = False
+    return mask
+
+def lowpass_stack(stack, bw, workers=-1):
+    """Remove the frequencies beyond bw (in pixels of the spectrum) of every image of
+    stack, shape (..., ny, nx), with a single batched real FFT."""
+    ny, nx = stack.shape[-2:]
+    ft = rfft2(stack, workers=workers)
+    ft *= _lowpass_mask(ny, nx, bw)
+    return irfft2(ft, s=(ny, nx), workers=workers, overwrite_x=True)
+
 def lowpass_filter(bw, *amps):
-    ny, nx = amps[0].shape
-    y, x = np.mgrid[-ny//2:ny//2, -nx//2:nx//2]
-    mask = x*x + y*y < bw*bw
-    filtered = []
-    for A in amps:
-        a_ft = fftshift(fft2(ifftshift(A)))
-        a_ft *= mask
-        a_filt = fftshift(ifft2(ifftshift(a_ft)))
-        filtered.append(a_filt)
-    return filtered
+    """Low pass filtered copies of each of the images amps. See lowpass_stack."""
+    return list(lowpass_stack(np.stack(amps), bw))
+
+# Identifies each dataset loaded in the process, for the keys of the inputs sent to the pool
+_dataset_ids = itertools.count()
 
 class SinglePhaseRetriever():
     # TODO: Crea una classe que encapsuli completament el mètode de recuperació de fase
-    def __init__(self, n_max=200):
+    def __init__(self, n_max=200, pool=None):
         self.options = {
             "pixel_size":None,  # MUST BE SCALED ACCORDING TO THE WAVELENGTH
             "dim"       :256,
+            "dim_policy":"nearest", # Move dim to a fast FFT size, see misc/fft_size.py
             "rect"      :None,
             "n_max"     :n_max,
             "eps"       :0.01,
             "bandwidth" :None,
             "origin"    :None,
             "lamb"      :None,
-            "path"      :None
+            "path"      :None,
+            "workers"   :-1,    # FFT threads used by the retrieval, -1 for all cores
+            "precision" :"double",  # "single", "double" or "mixed"
+            "ensemble"  :1,     # Number of random initial phases tried for each component
+            "checkpoint":None,  # File where the state of the retrieval is periodically saved
+            "checkpoint_every":50,
+            "accelerator":"alpha",      # Acceleration of the iterations, see algorithm/accelerators.py
+            "accelerator_options":None, # e.g. {"depth":5} for the anderson accelerator
+            "io_workers":None,  # Threads decoding images, None for one per core (plus 4)
+            "cache_dir":DEFAULT_CACHE_DIR,  # Cache of decoded images, None to disable it
+            "cache_size":2**31, # Bytes
+            "spectral_crop":False,  # Iterate on the smallest grid holding the bandwidth
+            "guard"     :4      # Frequency pixels added around the bandwidth by spectral_crop
             }
         self.irradiance = None
         self.images = {}
         self.cropped = {}
         self.cropped_irradiance = None
         self.a_ft = None
+        self.bandwidth_confidence = None
+        self.work_dim = None    # Size of the grid of the iterations, dim unless spectral_crop
+        self.A_work = None      # Amplitudes of the first plane on that grid
         self.mse = [[], []]
+        self.statistics = None
+        self.transport = None
+        # Pool of processes doing the retrievals. It may be shared by several retrievers,
+        # otherwise it is created on the first retrieval and shut down by close.
+        self.pool = pool
+        self.own_pool = pool is None
+        self.request = None
+        self.job = None
+        self.dataset_id = None
+        self.inputs_key = None  # Token identifying the last inputs, see prepare_inputs
 
     def __getitem__(self, key):
         return self.options[key]
@@ -89,18 +141,20 @@ class SinglePhaseRetriever():
             self.polarimetric_sets = get_polarimetric_names(path)
         elif kind == "npz":
             self.polarimetric_sets = get_polarimetric_npz(path)
+        elif kind == "container":
+            # A single file, memory mapped (see misc/container.py)
+            self.polarimetric_sets = get_polarimetric_container(path)
         if not self.polarimetric_sets:
             raise ValueError(f"Cannot load polarimetric images from {path}")
 
-        # Load all images into memory
-        for z in self.polarimetric_sets:
-            self.images[z] = {}
-            for polarization in self.polarimetric_sets[z]:
-                if type(polarization) != int:
-                    continue
-                path = self.polarimetric_sets[z][polarization]
-                image = imageio.imread(path)
-                self.images[z][polarization] = image.astype(np.float64)
+        # The images are decoded on demand: only the reference plane at full frame, for the
+        # irradiance, and the region of interest of every plane once the window is known.
+        # Decode times of each file are kept in self.loader.timings
+        self.loader = cached_loader(self["io_workers"], self["cache_dir"], self["cache_size"])
+        self.images = ImageStore(self.polarimetric_sets, self.loader)
+        self.dataset_id = next(_dataset_ids)
+        self.cropped = {}
+        self.cropped_irradiance = None
 
         # Compute irradiance
         self._compute_irradiance()
@@ -113,11 +167,9 @@ class SinglePhaseRetriever():
         # We only use one of the planes to compute the irradiance
         zetes = list(self.images.keys())
         z = zetes[0]    # We don't care which one...
-        images = self.images[z]
-        for polarization in images:
-            if type(polarization) != int:
-                continue
-            self.irradiance += images[polarization]
+        for image in self.images.full_plane(z).values():
+            # Camera data has at most 16 bits, so single precision is exact
+            self.irradiance += image.astype(np.float32)
 
         self.irradiance /= 3
 
@@ -125,23 +177,14 @@ class SinglePhaseRetriever():
         if not self.images:
             raise ValueError("Images not yet loaded")
 
-        y0, x0 = top
-        y1, x1 = bottom
-        first = True
-        for z in self.images:
-            self.cropped[z] = {}
-            if first:
-                self.cropped_irradiance = 0
-            for polarization in self.images[z]:
-                if type(polarization) != int:
-                    continue
-                image = self.images[z][polarization]
-                cropped = image[y0:y1, x0:x1]
-                self.cropped[z][polarization] = cropped
-                if first:
-                    # We also compute the cropped irradiance
-                    self.cropped_irradiance += cropped
-            first = False
+        self.images.set_rect((top, bottom))
+        # Cropped images in single precision, decoded when first needed
+        self.cropped = self.images.cropped(np.float32)
+        # We also compute the cropped irradiance
+        z = next(iter(self.images))
+        self.cropped_irradiance = 0
+        for image in self.cropped[z].values():
+            self.cropped_irradiance += image
         # And that's THA'
 
     def center_window(self):
@@ -183,101 +226,229 @@ class SinglePhaseRetriever():
             self._crop_images(*self["rect"])
         # Compute the Fourier Transform of the cropped irradiance to get its bandwidth
         self._compute_spectrum()
-        r = get_function_radius(self.a_ft, tol=tol)/2
-        if not r:
-            raise ValueError("Could not estimate the Bandwidth of the beam")
-        self.options["bandwidth"] = r
+        r, confidence = estimate_radius(self.a_ft, tol=tol)
+        if r is None:
+            raise ValueError("Could not estimate the Bandwidth of the beam: its spectrum is "
+                    f"below {tol} times its maximum everywhere")
+        if confidence < 0.5:
+            # Best effort, e.g. a tolerance at the noise floor of the spectrum
+            warnings.warn(f"Unreliable bandwidth {r/2:.2f} (confidence {confidence:.2f}), "
+                    "consider a larger tol")
+        self.options["bandwidth"] = r/2
+        # Fraction of the spectrum beyond the bandwidth at the noise floor, see estimate_radius
+        self.bandwidth_confidence = confidence
         return self.a_ft
 
-    def retrieve(self, args=(), monitor=True):
-        """Phase retrieval process. Using the configured parameters, begin the phase retrieval process."""
+    def prepare_inputs(self):
+        """Inputs of the iterations: the transfer functions between each pair of planes and the
+        filtered amplitudes of both components, stacked with shape (planes, 2, n, n). n is dim,
+        or with spectral_crop the reduced size given by reduced_dim, kept in self.work_dim."""
+        lamb = self.options["lamb"]
+        bw = self.options["bandwidth"]
+        # Amplitudes in the precision of the first iterations
+        dtype = np.float32 if self["precision"] == "single" else np.float64
+        # First, we construct the field amplitudes
+        zetes = sorted(self.cropped)
+        # Decode the regions of interest of all planes at once
+        self.images.prefetch(zetes, [0, 2])
+        # Only these two polarizations, self.cropped[z] would decode the six of the plane
+        I = np.stack([[self.images.roi(z, 2), self.images.roi(z, 0)] for z in zetes]).astype(dtype)
+        # Filtering the irradiances to remove high frequency noise fluctuations, all at once
+        As = lowpass_stack(I, bw*2, self["workers"])
+        del I
+        # Ringing of the filter may leave slightly negative irradiances
+        np.maximum(As, 0, out=As)
+        np.sqrt(As, out=As)
+        self.A_x = list(As[:, 0])
+        self.A_y = list(As[:, 1])
+        n = self.options["dim"]
+        m = reduced_dim(n, bw, self["guard"]) if self["spectral_crop"] else n
+        if m < n:
+            # Beyond the bandwidth everything is zeroed by H, so the iterations can run on a
+            # coarser grid with the same extent. The filtered irradiances are band limited,
+            # cropping their spectra samples them exactly on it.
+            I = np.real(fourier_resample(As*As, (m, m))).astype(dtype)
+            np.maximum(I, 0, out=I)
+            As = np.sqrt(I, out=I)
+        self.work_dim = m
+        self.A_work = As[0]
+        # Everything the inputs depend on, so that the pool does not need to hash them
+        self.inputs_key = repr((self.dataset_id, self["rect"], n, m, self["pixel_size"], lamb, bw,
+            np.dtype(dtype).str, zetes))
+        # Then, we need the free space transfer function H between each pair of planes. On the
+        # reduced grid, the central frequencies of the one of the full grid, so that both grids
+        # propagate with exactly the same frequencies
+        H = gap_transfer_functions(n, self["pixel_size"], lamb, zetes, bw, grid=m)
+        return H, As
+
+    def retrieve(self, args=(), monitor=True, resume=None, initial=None):
+        """Phase retrieval process. Using the configured parameters, begin the phase retrieval process.
+        If resume is the path of a checkpoint saved by a previous retrieval with the same
+        configuration, the iterations continue from it instead. A previous result can be used as
+        the initial estimate through initial (see _initial_phases)."""
         self.mse = [[], []] # Delete all possible values of the last mse
+        self.statistics = None
+        state = None
+        checkpoint = self["checkpoint"]
+        if resume:
+            state = load_checkpoint(resume)
+            # Keep checkpointing on the same file unless told otherwise
+            checkpoint = checkpoint or resume
         if not self.options["pixel_size"]:
             raise ValueError("Pixel size not specified")
         if not self.options["bandwidth"]:
             self.compute_bandwidth()
         if not self.options["origin"]:
             self.select_phase_origin()
-        lamb = self.options["lamb"]
-        p_size = self.options["pixel_size"]/lamb
-        bw = self.options["bandwidth"]
-        # First, we construct the field amplitudes
-        self.A_x = A_x = []
-        self.A_y = A_y = []
-        for z in self.cropped:
-            I_x = self.cropped[z][2]
-            I_y = self.cropped[z][0]
-            # Filtering the irradiances to remove high frequency noise fluctuations
-            A_xfilt = np.real(np.sqrt(lowpass_filter(bw*2, I_x)[0]))
-            A_yfilt = np.real(np.sqrt(lowpass_filter(bw*2, I_y)[0]))
-            A_x.append(A_xfilt)
-            A_y.append(A_yfilt)
-        # Then, we need to compute the free space transfer function H
-        n = self.options["dim"]
-        ny, nx = np.mgrid[-n//2:n//2, -n//2:n//2]
-        bandwidth_mask = (ny*ny+nx*nx < bw*bw)
-        umax = .5/p_size
-        x = nx/nx.max()*umax
-        y = ny/ny.max()*umax
-        rho2 = x*x+y*y
-        gamma = np.zeros((n, n), dtype=np.float_)
-        np.sqrt(1-rho2, out=gamma, where=bandwidth_mask)
-        zetes = list(self.images.keys())
-        dz = (zetes[1]-zetes[0])/lamb
-        H = np.exp(2j*np.pi*gamma*dz)
-        # Get the bandwidth of the beam we are computing and remove all values of H lying outside this region.
-        H[:] = fftshift(H*bandwidth_mask)
+        H, As = self.prepare_inputs()
+        n = self.work_dim
+        precision = self["precision"]
         # Finally, we create an initial guess for the phase of both components
         #phi_0 = np.zeros((n, n))
-        phi_0 = np.random.rand(n, n)
+        if initial is not None:
+            phi_0 = self._initial_phases(initial)
+            if n != self["dim"]:
+                # To the reduced grid of spectral_crop, through the band limited field as in
+                # get_phases
+                A = np.stack((self.A_x[0], self.A_y[0]))
+                phi_0 = np.angle(fourier_resample(A*np.exp(1j*phi_0), (n, n)))
+        else:
+            phi_0 = np.random.rand(n, n)
         #phi_0 = np.arctan2(x, y)
 
-        # We set up the multiprocessing environment. Just two processes, as we have two phases to recover
-        self.queues = [mp.Queue(), mp.Queue()]
-        p1, c1 = mp.Pipe()
-        p2, c2 = mp.Pipe()
-        # As queues only work with base types, we need to separate real and imaginary parts of the result
-        self.reals = [mp.Array("d", range(0, int(n**2))), mp.Array("d", range(0, int(n**2)))]
-        self.imags = [mp.Array("d", range(0, int(n**2))), mp.Array("d", range(0, int(n**2)))]
-        # List with each of the processes, to keep track of them
+        # We set up the multiprocessing environment. A single worker of the pool retrieves both
+        # phases at once, stacking the X and Y components into one batch. The MSE and the result
+        # are shared with the monitor through a block of shared memory, reused between retrievals.
+        shape = (n, n)
+        if self.transport is not None and (self.transport.shape != shape or
+                self.transport.capacity != self.options["n_max"] or
+                (self.job is not None and not self.job.done())):
+            self.transport.close()
+            self.transport = None
+        if self.transport is None:
+            self.transport = SharedTransport(2, shape, self.options["n_max"])
+        self.transport.reset()
         eps = self["eps"]
-        self.processes = \
-                [mp.Process(target=multi, args=(H, self.options["n_max"], phi_0, *A_x),
-                    kwargs={"queue":self.queues[0], "real":self.reals[0], "imag":self.imags[0], "eps":eps}),
-                 mp.Process(target=multi, args=(H, self.options["n_max"], phi_0, *A_y),
-                     kwargs={"queue":self.queues[1], "real":self.reals[1], "imag":self.imags[1], "eps":eps})]
+        kwargs = {"niter":self.options["n_max"], "transport":self.transport, "eps":eps,
+                  "workers":self["workers"], "precision":precision, "checkpoint":checkpoint,
+                  "checkpoint_every":self["checkpoint_every"], "state":state,
+                  "accelerator":self["accelerator"],
+                  "accelerator_options":self["accelerator_options"]}
+        n_seeds = self["ensemble"]
+        if state is not None:
+            # Recover the MSE of the iterations already done
+            mses = state["mses"][:int(state["iteration"])]
+            for i, mse in enumerate(np.split(mses, 2, axis=1)):
+                mse = np.where(mse > 0, mse, np.inf).min(axis=1)
+                for e in mse[np.isfinite(mse)]:
+                    self.transport.push(i, e)
+            self.read_mse()
+        if n_seeds > 1:
+            # Several initial phases per component, in the same batch. Only the best
+            # one of each component is kept, the statistics of the rest are sent back.
+            kwargs["n_seeds"] = n_seeds
+            if initial is not None:
+                kwargs["phi0"] = phi_0
+            self.request = ("ensemble", H, As, self.inputs_key, kwargs)
+        else:
+            kwargs["phi0"] = phi_0
+            self.request = ("batched", H, As, self.inputs_key, kwargs)
         # Begin monitoring
         if monitor:
             self.monitor_process(*args)
-        return A_x, A_y
+        return self.A_x, self.A_y
+
+    def _initial_phases(self, initial):
+        """Phases of both components of a previous result, adapted to the current window.
+        initial may be the path of a phases.npz file (as saved by the GUIs), a dict-like
+        object with the same keys ("phi_x", "phi_y" and optionally "rect" and
+        "pixel_size"), or a pair (exphi_x, exphi_y). If the result was obtained with a
+        different window, it is moved to the current one, and if its sampling differs,
+        it is resampled. Needs the amplitudes of prepare_inputs."""
+        if isinstance(initial, str):
+            with np.load(initial) as data:
+                initial = {key: data[key] for key in data.files}
+        if isinstance(initial, (tuple, list)):
+            initial = {"phi_x": initial[0], "phi_y": initial[1]}
+        n = self["dim"]
+        ratio = 1
+        p_size = initial.get("pixel_size")
+        if p_size is not None and self["pixel_size"] and p_size != self["pixel_size"]:
+            ratio = p_size/self["pixel_size"]
+        # Size of the current window in pixels of the previous result
+        m = int(round(n/ratio))
+        phases = []
+        for key, A in (("phi_x", self.A_x[0]), ("phi_y", self.A_y[0])):
+            field = np.asarray(initial[key])
+            # Move it to the current window, in its own pixels
+            rect = initial.get("rect")
+            if rect is not None and self["rect"] is not None and field.shape == tuple(np.subtract(rect[1], rect[0])):
+                v0, u0 = [int(round(c/ratio)) for c in self["rect"][0]]
+                field = recrop(field, rect, ((v0, u0), (v0+m, u0+m)))
+            elif field.shape != (m, m):
+                # Without knowing where it was, we assume both windows share their center
+                cy, cx = field.shape[0]//2, field.shape[1]//2
+                field = recrop(field, ((0, 0), field.shape), ((cy-m//2, cx-m//2), (cy-m//2+m, cx-m//2+m)))
+            if m != n:
+                # Then to the current pixel size. exp(i*phi) is not band limited, the field with
+                # the measured amplitude is, so we resample the field and keep only its phase
+                A = np.maximum(np.real(fourier_resample(A, (m, m))), 0)
+                field = fourier_resample(A*field, (n, n))
+            phases.append(np.angle(field))
+        return np.stack(phases)
 
     def update_function(self, *args):
         pass
 
+    def start(self):
+        """Submit the retrieval prepared by retrieve to the pool of workers. Only the initial
+        phase and the options are sent if the worker already holds the same inputs."""
+        if self.pool is None:
+            self.pool = RetrievalPool()
+        target, H, As, key, kwargs = self.request
+        if self.job is not None and not self.job.done():
+            # A retrieval of this retriever still running is replaced by the new one
+            self.job.cancel()
+        self.job = self.pool.submit(target, H, As, key=key, **kwargs)
+
     def monitor_process(self, *args):
         # TODO: Aconsegueix-ne les fases ajustades
-        for p in self.processes:
-            p.start()
-            p.join(timeout=0)
-        alive = any([p.is_alive() for p in self.processes])
+        self.start()
+        alive = True
         while alive:
-            for i, p in enumerate(self.processes):
-                full = True
-                while full:
-                    try:
-                        data = self.queues[i].get_nowait()
-                        self.mse[i].append(data)
-                    except:
-                        full = False
-            alive = any([p.is_alive() for p in self.processes])
+            alive = not self.job.done(timeout=0.01)
+            self.read_mse()
             # Update through an update function if necessary
             self.update_function(*args)
-    
+        # Raise here any error of the worker
+        self.job.result()
+
+    def read_mse(self):
+        """Point self.mse to the MSE of each component written so far by the retrieval."""
+        self.mse = [self.transport.history(i) for i in range(self.transport.n_sources)]
+
+    def close(self):
+        """Free the shared memory of the last retrieval, whose phases and MSE can no longer
+        be read afterwards, and shut down the pool of workers if it belongs to the retriever.
+        A retrieval still running is stopped."""
+        self.mse = [[], []]
+        if self.pool is not None and self.own_pool:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
     def get_phases(self):
         """Convert the multiprocessing arrays into the 2D phase distributions."""
-        dim = self.options["dim"]
-        exphi_x = (np.asarray(self.reals[0])+1j*np.asarray(self.imags[0])).reshape((dim, dim))
-        exphi_y = (np.asarray(self.reals[1])+1j*np.asarray(self.imags[1])).reshape((dim, dim))
+        exphi_x, exphi_y = self.transport.result
+        n = self["dim"]
+        if exphi_x.shape != (n, n):
+            # Retrieved on the reduced grid of spectral_crop, back to the sampling of the window.
+            # exp(i*phi) is not band limited, the field A*exp(i*phi) is, so we resample the field
+            # and keep only its phase
+            E = fourier_resample(self.A_work*self.transport.result, (n, n))
+            exphi_x, exphi_y = E/(np.abs(E)+np.finfo(float).tiny)
         # Now, impose the phase difference as obtained experimentally through the Stokes parameters
         stokes = self.get_stokes()
         delta = np.arctan2(stokes[3], stokes[2])
@@ -286,21 +457,39 @@ class SinglePhaseRetriever():
         delta_0 = delta[origin[0], origin[1]]
         e_delta_0 = np.exp(-1j*delta_0) # -1j Seems to be THE RIGHT WAY(TM) to do it
 
-        exphi_x /= exphi_x[origin[0], origin[1]]
-        exphi_y /= exphi_y[origin[0], origin[1]]
-        exphi_y *= e_delta_0
+        # The result stays untouched in the shared memory
+        exphi_x = exphi_x/exphi_x[origin[0], origin[1]]
+        exphi_y = exphi_y*(e_delta_0/exphi_y[origin[0], origin[1]])
         return exphi_x, exphi_y
 
+    def get_statistics(self):
+        """Per seed statistics of the last ensemble retrieval (see multi_ensemble)."""
+        if self.statistics is None:
+            if self["ensemble"] <= 1:
+                raise ValueError("Statistics are only available for ensemble retrievals")
+            self.statistics = self.job.result()
+        return self.statistics
+
     def get_stokes(self):
         irradiances = [self.cropped[0][pol] for pol in range(6)]
         return get_stokes_parameters(irradiances)
 
     def config(self, **options):
         #def config(self, pixel_size=None, dim=256, n_max=200, eps=0.01, radius=None, origin=None):
-        for option in options:
+        # The policy applies to a dim given in the same call
+        for option in sorted(options, key=lambda option: option != "dim_policy"):
             # If the option is in the list, we change it...
             if option in self.options:
+                if option == "precision" and options[option] not in PRECISIONS:
+                    raise ValueError(f"Precision must be one of {list(PRECISIONS)}")
+                if option == "accelerator" and options[option] not in ACCELERATORS:
+                    raise ValueError(f"Accelerator must be one of {list(ACCELERATORS)}")
+                if option == "dim_policy" and options[option] not in POLICIES:
+                    raise ValueError(f"Policy of dim must be one of {list(POLICIES)}")
                 self.options[option] = options[option]
+                if option == "dim":
+                    # Sizes with large prime factors make every FFT of the iterations slower
+                    self.options[option] = fft_dim(options[option], self["dim_policy"])
                 if option == "path":
                     self.load_dataset(options[option])
                 elif option == "rect":
@@ -21,29 +21,19 @@ class GUIRetriever(PhaseRetriever):
 
     def monitor_process(self, *args):
         self.finished = False
-        for p in self.processes:
-            p.start()
-            #p.join(timeout=0)
+        self.start()
         wx.CallLater(delta_t, self.check_status, *args)
 
     def check_status(self, plot):
-        for i, p in enumerate(self.processes):
-            full = True
-            while full:
-                try:
-                    data = self.queues[i].get_nowait()
-                    self.mse[i].append(data)
-                except:
-                    full = False
-            status = any([p.is_alive() for p in self.processes])
+        status = not self.job.done()
+        self.read_mse()
         self.update_function(plot)
-        # Check the processes again if they are still alive
+        # Check the job again if it is still running
         if status:
             # FIXME: Recursion!!!!
             wx.CallLater(delta_t, self.check_status, plot)
         else:
-            for p in self.processes:
-                p.join(timeout=0)
+            self.job.result()
             self.finished = True
 
     def update_function(self, plot):
@@ -72,7 +62,8 @@ class wxGUI(wx.Frame):
         self.init()
         self.Centre()
 
-        self.propagator = FocalPropagator()
+        # z in wavelength units, planes closer than a thousandth of a wavelength are shared
+        self.propagator = FocalPropagator(z_step=1e-3)
 
     def init(self):
         # Initializing the plotter
@@ -124,6 +115,7 @@ class wxGUI(wx.Frame):
         self.Bind(wx.EVT_MENU, self.OnDump, fileSave)
         self.Bind(wx.EVT_MENU, self.OnLoad, fileLoad)
         self.Bind(wx.EVT_MENU, self.OnExport, fileExport)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
 
         # TODO: Initialize the phase retriever
         self.retriever = GUIRetriever()
@@ -133,8 +125,9 @@ class wxGUI(wx.Frame):
         # We center the window with the size given by the entries.
         configs = self.entries.GetValues()
         print(configs)
-        window_size = configs["window_size"]
-        self.retriever.config(dim=window_size)
+        self.retriever.config(dim=configs["window_size"])
+        # The retriever may move it to a size fast for the FFT
+        window_size = self.retriever["dim"]
         top, bottom = self.retriever.center_window()
         rect_center = top[0]+window_size//2, top[1]+window_size//2
         # Adjust the phase origin
@@ -144,7 +137,7 @@ class wxGUI(wx.Frame):
         bw = self.retriever.options["bandwidth"]
 
         # Set the autoadjusted values to the entry panel
-        self.entries.SetValue(bandwidth=bw, 
+        self.entries.SetValue(bandwidth=bw, window_size=window_size,
                 window_center=[str(x) for x in rect_center],
                 phase_origin=[str(x) for x in phase_origin])
 
@@ -163,13 +156,16 @@ class wxGUI(wx.Frame):
         values = self.entries.GetValues()
         bw = values["bandwidth"]*2
         rect_center = values["window_center"]
-        width = values["window_size"]
+        self.retriever["dim"] = values["window_size"]
+        width = self.retriever["dim"]
+        if width != values["window_size"]:
+            self.entries.SetValue(window_size=width)
         print(width)
         top = [int(i)-width//2 for i in rect_center]
         bottom = [int(i)+width//2 for i in rect_center]
         # Change configurations on the retriever
         self.retriever.config(path=values["path"], lamb=values["lamb"],
-                rect=(top, bottom), bandwidth=bw/2, dim=width, pixel_size=values["pixel_size"], n_max=values["n_iter"])
+                rect=(top, bottom), bandwidth=bw/2, pixel_size=values["pixel_size"], n_max=values["n_iter"])
         self.retriever._compute_spectrum()
         #a_ft_log = np.log10(self.retriever.a_ft)
         # Plot the relevant information...
@@ -331,7 +327,8 @@ class wxGUI(wx.Frame):
         try:
             Ax, Ay = self.retriever.A_x, self.retriever.A_y
             ephi_x, ephi_y = self.retriever.get_phases()
-            data = {"A_x":Ax, "A_y":Ay, "phi_x": ephi_x, "phi_y": ephi_y}
+            data = {"A_x":Ax, "A_y":Ay, "phi_x": ephi_x, "phi_y": ephi_y,
+                    "rect": self.retriever["rect"], "pixel_size": self.retriever["pixel_size"]}
 
             with wx.FileDialog(self, "Save recovered data", style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT, 
                     wildcard="*.npz") as save_dialog:
@@ -366,6 +363,8 @@ class wxGUI(wx.Frame):
                 width = values[key]
                 if width != self.retriever["dim"]:
                     self.retriever["dim"] = width
+                    width = self.retriever["dim"]
+                    self.entries.SetValue(window_size=width)
                     rect_center = values["window_center"]
                     top = [int(i)-width//2 for i in rect_center]
                     bottom = [int(i)+width//2 for i in rect_center]
@@ -389,6 +388,12 @@ class wxGUI(wx.Frame):
     def OnQuit(self, event):
         self.Close()
 
+    def OnClose(self, event):
+        # Free the shared memory of the last retrieval before leaving
+        self.retriever.close()
+        self.propagator.close()
+        event.Skip()
+
 if __name__ == "__main__":
     app = wx.App()
     gui = wxGUI(None, "Phase retriever")
@@ -1,4 +1,5 @@
 from phase_retriever import PhaseRetriever
+from phase_retriever.misc.focalprop import FocalPropagator
 from scipy.fft import fft2, ifft2, fftshift, ifftshift
 import numpy as np
 import matplotlib.pyplot as plt
@@ -6,24 +7,14 @@ OK = "\033[0;32mOK\033[0;0m"
 FAIL = "\033[91mFAIL\033[0;0m"
 
 def get_Ez(Ex, Ey, pixel_size, lamb):
-    ny, nx = Ex.shape
-    y, x = np.mgrid[-ny//2:ny//2, -nx//2:nx//2]
-    # Cosinus directors
-    umax = .5/pixel_size*lamb
-    alpha = x/x.max()*umax
-    beta = y/y.max()*umax
-    gamma = np.zeros((ny, nx), dtype=np.float64)
-    rho2 = alpha*alpha+beta*beta
-    np.sqrt(1-rho2, where=rho2 < 1, out=gamma)
-
-    # Càlcul del camp per se
-    ft_Ex = fftshift(fft2(ifftshift(Ex)))
-    ft_Ey = fftshift(fft2(ifftshift(Ey)))
-    ft_Ez = alpha*ft_Ex+beta*ft_Ey
-    ft_Ez[gamma>0] /= gamma[gamma>0]
-
-    Ez = fftshift(ifft2(ifftshift(ft_Ez)))
-    return Ez
+    propagator = FocalPropagator(cache_bytes=0, prefetch=0)
+    propagator["Ex"] = Ex
+    propagator["Ey"] = Ey
+    propagator["pixel_size"] = pixel_size/lamb
+    propagator.create_gamma()
+    propagator.create_spectra()
+    # Field at the plane of Ex, Ey
+    return propagator.propagate_field_to(0, longitudinal=True)[2]
 
 def test_basics():
     success = True